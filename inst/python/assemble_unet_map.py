@@ -0,0 +1,187 @@
+"""
+Assemble U-Net map patch predictions into a GeoTIFF, block by block
+
+Python counterpart of the accumulation in unet_assemble_map.R. Overlapping
+patch probabilities are averaged with the same distance-to-edge weights, but
+the raster is processed in horizontal stripes of block_rows rows: only the
+patches touching a stripe are read (probabilities and nodata are memory-mapped),
+accumulation, argmax and the original-class mapping are vectorized NumPy, and
+each finished stripe is written as a window of a tiled GeoTIFF. Peak memory is
+bounded by the stripe height rather than the size of the raster. Uncertainty
+layers written by predict_unet_map(uncertainty=True) are stitched the same way.
+Called from R via reticulate; R adds the color table and VAT afterwards.
+"""
+
+import os
+import csv
+import json
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+
+
+CLASS_NODATA = 255                                              # INT1U nodata, as terra writes NA
+UNCERTAINTY_NODATA = 255                                        # uncertainty layers are uint8 0-100
+
+
+def edge_weights(patch_size, use_distance_weights=True):
+    """Distance-to-nearest-edge weight for each pixel of a patch (as in unet_assemble_map.R)"""
+    if not use_distance_weights:
+        return np.ones((patch_size, patch_size))
+    if patch_size % 2 != 0:
+        raise ValueError(f'patch_size must be even for distance weighting (got {patch_size})')
+    half = patch_size // 2
+    ramp = np.concatenate([np.arange(1, half + 1), np.arange(half, 0, -1)]) / half
+    return np.minimum.outer(ramp, ramp)
+
+
+def read_origins(patches_dir):
+    """Patch origins (0-indexed row, col of each patch's top-left pixel) from patch_origins.csv"""
+    with open(os.path.join(patches_dir, 'patch_origins.csv'), newline='') as f:
+        rows = list(csv.DictReader(f))
+    row0 = np.array([int(float(r['row'])) for r in rows], dtype=np.int64)
+    col0 = np.array([int(float(r['col'])) for r in rows], dtype=np.int64)
+    return row0, col0
+
+
+def assemble_unet_map(patches_dir, class_file, original_classes, probs_file=None,
+                      use_distance_weights=True, block_rows=1024, site=None, uncertainty_file=None):
+    """
+    Average overlapping patch probabilities and write the class raster by row blocks.
+
+    Args:
+        patches_dir: Directory with map probabilities, nodata, origins, and metadata
+        class_file: Output GeoTIFF for the classification (original class numbers, uint8)
+        original_classes: Original class number for each internal class index
+        probs_file: Optional output GeoTIFF for per-class probabilities (float32, one band per class)
+        use_distance_weights: Weight pixels by distance to the nearest patch edge
+        block_rows: Height of each processing stripe in rows; bounds peak memory
+        site: Site code (default: from map_metadata.json)
+        uncertainty_file: Optional output GeoTIFF for the uncertainty layers
+            ({SITE}_map_uncertainty.npy from predict_unet_map), uint8 percent,
+            one band per layer, named in the band descriptions
+
+    Returns:
+        Dict with classes (original class numbers present in the map) and
+        n_valid (number of non-nodata pixels)
+    """
+
+    with open(os.path.join(patches_dir, 'map_metadata.json'), 'r') as f:
+        meta = json.load(f)
+    site = (site or meta['site']).upper()
+
+    patch_size = int(meta['patch_size'])
+    n_rows = int(meta['n_rows_rast'])
+    n_cols = int(meta['n_cols_rast'])
+
+    probs = np.load(os.path.join(patches_dir, f'{site}_map_probs.npy'), mmap_mode='r')    # (n_patches, K, H, W)
+    nodata = np.load(os.path.join(patches_dir, f'{site}_map_nodata.npy'), mmap_mode='r')  # (n_patches, H, W)
+    row0, col0 = read_origins(patches_dir)
+    n_patches, n_classes = probs.shape[0], probs.shape[1]
+    uncert = None
+    if uncertainty_file is not None:
+        uncert_path = os.path.join(patches_dir, f'{site}_map_uncertainty.npy')
+        if not os.path.exists(uncert_path):
+            raise FileNotFoundError(f'{uncert_path} not found; predict with uncertainty=True to write it')
+        uncert = np.load(uncert_path, mmap_mode='r')            # (n_patches, L, H, W) uint8
+        with open(os.path.join(patches_dir, f'{site}_map_uncertainty.json'), 'r') as f:
+            layer_names = json.load(f)['layers']
+
+    class_lookup = np.asarray(original_classes, dtype=np.int64)
+    if class_lookup.size != n_classes:
+        raise ValueError(f'{class_lookup.size} original classes given for {n_classes} predicted classes')
+    if class_lookup.max() >= CLASS_NODATA:
+        raise ValueError(f'class numbers must be < {CLASS_NODATA} to write as uint8')
+
+    weight = edge_weights(patch_size, use_distance_weights)
+
+    block_rows = max(1, int(block_rows))
+    order = np.argsort(row0, kind='stable')                     # patches sorted by top row, for stripe lookup
+    sorted_row0 = row0[order]
+
+    print(f'Assembling {n_patches} patches into {n_cols} x {n_rows} raster '
+          f'({n_classes} classes) in {int(np.ceil(n_rows / block_rows))} blocks of {block_rows} rows...')
+
+    profile = dict(driver='GTiff', height=n_rows, width=n_cols,
+                   crs=meta['crs'] or None,
+                   transform=from_bounds(meta['rast_xmin'], meta['rast_ymin'],
+                                         meta['rast_xmax'], meta['rast_ymax'], n_cols, n_rows),
+                   tiled=True, blockxsize=256, blockysize=256, compress='deflate', BIGTIFF='IF_SAFER')
+
+    os.makedirs(os.path.dirname(os.path.abspath(class_file)), exist_ok=True)
+    class_dst = rasterio.open(class_file, 'w', count=1, dtype='uint8', nodata=CLASS_NODATA, **profile)
+    probs_dst = None
+    if probs_file is not None:
+        probs_dst = rasterio.open(probs_file, 'w', count=n_classes, dtype='float32', nodata=np.nan, **profile)
+        for k in range(n_classes):
+            probs_dst.set_band_description(k + 1, f'prob_{int(class_lookup[k])}')
+    uncert_dst = None
+    if uncert is not None:
+        uncert_dst = rasterio.open(uncertainty_file, 'w', count=len(layer_names), dtype='uint8',
+                                   nodata=UNCERTAINTY_NODATA, **profile)
+        for k, name in enumerate(layer_names):
+            uncert_dst.set_band_description(k + 1, name)
+
+    present = np.zeros(n_classes, dtype=bool)
+    n_valid = 0
+
+    try:
+        for r0 in range(0, n_rows, block_rows):
+            r1 = min(r0 + block_rows, n_rows)
+            h = r1 - r0
+
+            accum = np.zeros((n_classes, h, n_cols))            # summed weighted probabilities
+            count = np.zeros((h, n_cols))                       # sum of weights
+            if uncert is not None:
+                u_accum = np.zeros((uncert.shape[1], h, n_cols))
+
+            # Patches whose rows [row0, row0 + patch_size) intersect [r0, r1)
+            lo = np.searchsorted(sorted_row0, r0 - patch_size, side='right')
+            hi = np.searchsorted(sorted_row0, r1, side='left')
+
+            for i in order[lo:hi]:
+                pr, pc = int(row0[i]), int(col0[i])
+                a = max(r0, pr)                                 # raster rows covered in this stripe
+                b = min(r1, pr + patch_size, n_rows)
+                c1 = min(pc + patch_size, n_cols)
+                if b <= a or c1 <= pc:
+                    continue
+                pa, pb = a - pr, b - pr                         # the same rows within the patch
+                width = c1 - pc
+
+                w_patch = weight[pa:pb, :width] * nodata[i, pa:pb, :width]
+                accum[:, a - r0:b - r0, pc:c1] += probs[i, :, pa:pb, :width] * w_patch
+                if uncert is not None:
+                    u_accum[:, a - r0:b - r0, pc:c1] += uncert[i, :, pa:pb, :width] * w_patch
+                count[a - r0:b - r0, pc:c1] += w_patch
+
+            is_nodata = count == 0
+            count[is_nodata] = 1                                # avoid division by zero
+            accum /= count
+
+            internal = np.argmax(accum, axis=0)                 # first max wins, as which.max
+            pred = class_lookup[internal]
+            pred[is_nodata] = CLASS_NODATA
+            present |= np.bincount(internal[~is_nodata], minlength=n_classes) > 0
+            n_valid += int((~is_nodata).sum())
+
+            window = Window(0, r0, n_cols, h)
+            class_dst.write(pred.astype(np.uint8), 1, window=window)
+            if probs_dst is not None:
+                accum[:, is_nodata] = np.nan
+                probs_dst.write(accum.astype(np.float32), window=window)
+            if uncert_dst is not None:
+                u = np.rint(u_accum / count)
+                u[:, is_nodata] = UNCERTAINTY_NODATA
+                uncert_dst.write(u.astype(np.uint8), window=window)
+
+            print(f'  Rows {r1} / {n_rows}')
+    finally:
+        class_dst.close()
+        if probs_dst is not None:
+            probs_dst.close()
+        if uncert_dst is not None:
+            uncert_dst.close()
+
+    return {'classes': [int(c) for c in class_lookup[present]], 'n_valid': n_valid}
@@ -0,0 +1,98 @@
+"""
+Background validation and test evaluation for U-Net training
+
+With async evaluation, train_unet() snapshots the model weights at the end of
+each epoch and hands them to a single worker thread, which loads them into its
+own copy of the model (on a separate device when there is one) and runs the
+validation and test passes while the next epoch trains. PyTorch releases the
+GIL during tensor work, so a thread is enough to overlap the two; the worker
+never touches the training model, optimizer, or feature cache.
+
+Results come back in epoch order. At most max_pending snapshots are waiting or
+running at once; when the evaluator falls further behind, submit() blocks on
+the oldest, which keeps snapshot memory bounded.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from unet_models import clean_state_dict
+
+
+def choose_eval_device(train_device, requested=None):
+    """
+    Device for background evaluation: requested if given, else the last GPU
+    when there are several, else the training device
+    """
+    if requested is not None:
+        return torch.device(requested)
+    if train_device.type == 'cuda' and torch.cuda.device_count() > 1:
+        return torch.device(f'cuda:{torch.cuda.device_count() - 1}')
+    return train_device
+
+
+class AsyncEvaluator:
+    """
+    Runs evaluations of weight snapshots in a background thread.
+
+    Args:
+        model: Model to evaluate with (same architecture as the training
+            model, without DataParallel); moved to device and kept in eval mode
+        evaluate: evaluate(model, loader) -> result, e.g. train_unet's validate()
+            with its criterion and config bound
+        device: Evaluation device
+        max_pending: Most snapshots queued or running before submit() waits
+    """
+
+    def __init__(self, model, evaluate, device, max_pending=2):
+        self.model = model.to(device)
+        self.model.eval()
+        self.evaluate = evaluate
+        self.device = device
+        self.max_pending = max_pending
+        self.pending = deque()                                  # (epoch, future), oldest first
+        self.finished = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='unet-eval')
+
+    def _run(self, state, loaders):
+        self.model.load_state_dict(state)
+        return {name: self.evaluate(self.model, loader) for name, loader in loaders.items()}
+
+    def submit(self, epoch, model, loaders):
+        """
+        Queue evaluation of model's current weights.
+
+        Args:
+            epoch: Epoch index the weights belong to
+            model: Training model (may be wrapped in DataParallel)
+            loaders: Dict of name -> DataLoader to evaluate on (may be empty)
+        """
+        while len(self.pending) >= self.max_pending:
+            epoch_done, future = self.pending.popleft()
+            self.finished.append((epoch_done, future.result()))
+        state = {k: v.detach().to(self.device, copy=True)
+                 for k, v in clean_state_dict(model.state_dict()).items()}
+        self.pending.append((epoch, self.executor.submit(self._run, state, loaders)))
+
+    def results(self, wait=False):
+        """
+        Evaluations finished so far, in epoch order.
+
+        Args:
+            wait: Block until every submitted evaluation is done
+
+        Returns:
+            List of (epoch, {name: result}) tuples not returned before
+        """
+        while self.pending and (wait or self.pending[0][1].done()):
+            epoch, future = self.pending.popleft()
+            self.finished.append((epoch, future.result()))
+        out = list(self.finished)
+        self.finished.clear()
+        return out
+
+    def close(self):
+        """Wait for the worker to finish and release it"""
+        self.executor.shutdown(wait=True)
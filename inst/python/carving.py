@@ -0,0 +1,83 @@
+"""
+Carve training labels to plot-sized disks at load time
+
+The pixel-degradation experiment trains on labels carved to radius-r disks
+around fixed synthetic plot centers, each disk clipped to its source
+transect. Rather than exporting a patch set per radius, degrade prep can
+export the full-transect patch set once per fold, plus two per-pixel arrays
+for the training patches:
+
+    <site>_train_plot_dist.npy  float32 distance (map units) from the pixel
+                                center to the nearest plot center on the
+                                pixel's own transect (inf where none)
+    <site>_train_plot_id.npy    int32 id of that plot (-1 where none)
+
+A pixel is in the radius-r carve when it is labeled in the full export and
+within r of its nearest plot center, matching the clipped-disk carve in R
+(up to st_buffer's polygonal approximation of the disk). Training patches
+left with no labeled pixels are dropped, and labels outside the carve are
+set to 255, as they would be at export, so a radius that removes every pixel
+of a class is caught by train_unet's class-count check.
+Validation and test splits are never carved.
+"""
+
+import os
+import numpy as np
+
+
+def carve_train_masks(masks, plot_dist, plot_id=None, radius=None, plots=None):
+    """
+    Carve full-transect training masks to plot disks
+
+    Args:
+        masks: [N, H, W] full-transect training masks (1 = labeled)
+        plot_dist: [N, H, W] distance to the nearest plot center
+        plot_id: [N, H, W] nearest plot id (needed with plots)
+        radius: Disk radius in map units; None keeps every pixel with a plot
+            center on its transect
+        plots: Optional plot ids to keep; pixels of other plots are dropped
+
+    Returns:
+        (carved masks for kept patches, indices of kept patches)
+    """
+    keep_px = np.isfinite(plot_dist) if radius is None else plot_dist <= radius
+    if plots is not None:
+        keep_px &= np.isin(plot_id, np.asarray(plots))
+    carved = np.where(keep_px, masks, 0).astype(masks.dtype)
+    keep = np.flatnonzero(carved.reshape(len(carved), -1).any(axis=1))
+    return carved[keep], keep
+
+
+def carve_train_split(data_dir, site, patches, labels, masks, radius=None, plots=None):
+    """
+    Carve a full-transect training split read from data_dir
+
+    Args:
+        data_dir, site: Where the split and its plot distance/id arrays live
+        patches, labels, masks: The loaded full-transect training split
+        radius, plots: As for carve_train_masks()
+
+    Returns:
+        (patches, labels, masks, log): labels are 255 wherever the carved mask
+        is 0, and log is a dict of the carve's radius, patch and pixel counts,
+        and number of plots contributing pixels
+    """
+    plot_dist = np.load(os.path.join(data_dir, f"{site}_train_plot_dist.npy"), mmap_mode='r')
+    plot_id = np.load(os.path.join(data_dir, f"{site}_train_plot_id.npy"), mmap_mode='r')
+    if plot_dist.shape != masks.shape:
+        raise ValueError(f"{site}_train_plot_dist.npy has shape {plot_dist.shape}; "
+                         f"training masks are {masks.shape}")
+
+    carved, keep = carve_train_masks(masks, plot_dist, plot_id, radius, plots)
+    n_plots = int(np.unique(np.asarray(plot_id)[keep][carved > 0]).size)
+    log = {
+        "radius": radius,
+        "n_plots": n_plots,
+        "n_patches": int(keep.size),
+        "train_pixels": int((carved > 0).sum()),
+        "full_train_pixels": int((masks > 0).sum()),
+    }
+    print(f"Carved training labels to radius {radius}: {log['train_pixels']:,} of "
+          f"{log['full_train_pixels']:,} pixels, {n_plots} plots, {keep.size} of {len(masks)} patches")
+    labels = np.where(carved > 0, labels[keep], 255).astype(labels.dtype)   # unlabeled, as in a per-radius export
+    return patches[keep], labels, carved, log
@@ -0,0 +1,295 @@
+"""
+Distill a U-Net ensemble into a single model for fast mapping
+
+Mapping with the ensemble of all CV folds runs every fold's U-Net over every
+map patch, so prediction cost grows with the number of folds. Distillation
+trains one student U-Net (optionally with a smaller encoder) to reproduce the
+ensemble's averaged class probabilities on the unlabeled map patches, and
+saves it with a standard model config JSON, so predict_unet_map() loads it
+like any other fit.
+
+Soft targets are the ensemble probabilities predict_unet_map() writes to
+<SITE>_map_probs.npy (resumable and cached as usual). The student is trained
+on most of the patches with a soft-target loss over valid (not nodata)
+pixels: cross-entropy for categorical models, corn_soft_loss_masked for
+ordinal ones. The remaining held-out patches measure agreement with the
+ensemble and the inference speedup.
+"""
+
+import os
+import csv
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from unet_models import build_unet, get_model, load_config, load_state_dict
+from ordinal import corn_probabilities, corn_soft_loss_masked
+from predict_unet_map import predict_unet_map
+
+
+def soft_target_loss(logits, target, valid, use_ordinal):
+    """Masked loss against the ensemble's class probabilities target [B, K, H, W]"""
+    if use_ordinal:
+        return corn_soft_loss_masked(logits, target, valid)
+    v = valid.to(logits.dtype)
+    ll = (target * F.log_softmax(logits, dim=1)).sum(dim=1)
+    return -(ll * v).sum() / v.sum()
+
+
+def class_probabilities(logits, use_ordinal):
+    """Per-class probabilities [B, K, H, W] from model output"""
+    return corn_probabilities(logits) if use_ordinal else torch.softmax(logits, dim=1)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class DistillData:
+    """
+    Batches of map patches, ensemble probabilities and valid-pixel masks, read
+    from the memory-mapped map prediction files in sorted index order
+    """
+
+    def __init__(self, patches, probs, nodata):
+        self.patches = patches                                   # (n, H, W, C)
+        self.probs = probs                                       # (n, K, H, W)
+        self.nodata = nodata                                     # (n, H, W), 1 = valid; None if all valid
+
+    def batch(self, idx, device):
+        idx = np.sort(np.asarray(idx))
+        x = torch.from_numpy(np.asarray(self.patches[idx.tolist()], dtype=np.float32).transpose(0, 3, 1, 2))
+        y = torch.from_numpy(np.asarray(self.probs[idx], dtype=np.float32))
+        if self.nodata is None:
+            v = torch.ones((len(idx),) + tuple(x.shape[2:]), dtype=torch.bool)
+        else:
+            v = torch.from_numpy(np.asarray(self.nodata[idx]) > 0)
+        return x.to(device), y.to(device), v.to(device)
+
+
+def evaluate_student(model, data, idx, batch_size, device, use_ordinal, num_classes):
+    """
+    Agreement of the student with the ensemble on held-out patches
+
+    Returns:
+        Dict of pixel agreement (argmax), mean absolute probability difference,
+        agreement within each ensemble class, and student seconds per patch
+    """
+    model.eval()
+    agree = total = 0
+    abs_diff = 0.0
+    class_agree = np.zeros(num_classes)
+    class_total = np.zeros(num_classes)
+    seconds = 0.0
+    with torch.no_grad():
+        for start in range(0, len(idx), batch_size):
+            x, y, v = data.batch(idx[start:start + batch_size], device)
+            _sync(device)
+            t0 = time.perf_counter()
+            p = class_probabilities(model(x), use_ordinal)
+            _sync(device)
+            seconds += time.perf_counter() - t0
+
+            teacher, student = y.argmax(dim=1)[v], p.argmax(dim=1)[v]
+            agree += (teacher == student).sum().item()
+            total += v.sum().item()
+            abs_diff += (p - y).abs().sum(dim=1)[v].sum().item()
+            class_total += torch.bincount(teacher, minlength=num_classes).cpu().numpy()
+            class_agree += torch.bincount(teacher[teacher == student], minlength=num_classes).cpu().numpy()
+    return {
+        'agreement': agree / max(total, 1),
+        'mean_abs_prob_diff': abs_diff / max(total, 1) / num_classes,
+        'class_agreement': [float(a / t) if t > 0 else None for a, t in zip(class_agree, class_total)],
+        'seconds_per_patch': seconds / max(len(idx), 1),
+    }
+
+
+def time_ensemble(teacher_weights, config, data, idx, batch_size, device, use_ordinal):
+    """Ensemble seconds per patch (every member plus averaging) on the same patches"""
+    models = [get_model(w, config, device) for w in teacher_weights]
+    seconds = 0.0
+    with torch.no_grad():
+        for start in range(0, len(idx), batch_size):
+            x, _, _ = data.batch(idx[start:start + batch_size], device)
+            _sync(device)
+            t0 = time.perf_counter()
+            p = sum(class_probabilities(m(x), use_ordinal) for m in models) / len(models)
+            _sync(device)
+            seconds += time.perf_counter() - t0
+    return seconds / max(len(idx), 1)
+
+
+def distill_unet(patches_dir, teacher_weights, config_path, output_dir, encoder_name=None,
+                 encoder_weights=None, n_epochs=10, batch_size=16, learning_rate=1e-4,
+                 weight_decay=1e-4, gradient_clip_max_norm=1.0, holdout_frac=0.1,
+                 max_patches=None, timing_patches=256, seed=42, requirecuda=True,
+                 cache_dir=None, cache_max_gb=20, chunk_size=1024):
+    """
+    Train a single student U-Net on an ensemble's map probabilities
+
+    Args:
+        patches_dir: Map patches directory (from unet_prep_map)
+        teacher_weights: List of .pth paths, the ensemble members
+        config_path: Teacher model config JSON (from training)
+        output_dir: Where to write the student weights, config, and report
+        encoder_name: Student encoder; None uses the teacher's. With the
+            teacher's encoder, the student starts from the first member's weights
+        encoder_weights: Pretrained weights for a different student encoder
+            ('imagenet' or None)
+        n_epochs: Passes over the training patches
+        batch_size: Patches per batch
+        learning_rate, weight_decay: Adam settings
+        gradient_clip_max_norm: Gradient clipping threshold
+        holdout_frac: Fraction of patches held out to measure agreement
+        max_patches: Optional cap on the patches used (random subset)
+        timing_patches: Held-out patches used to time ensemble vs student
+        seed: Random seed for the patch split, batch order, and augmentation
+        requirecuda: If True, stop when CUDA isn't available
+        cache_dir, cache_max_gb, chunk_size: Passed to predict_unet_map() for
+            the ensemble prediction
+
+    Returns:
+        Dict with the student's model_path and config_path, its agreement with
+        the ensemble on held-out patches, and the inference speedup
+    """
+
+    config = load_config(config_path)
+    use_ordinal = config.get('use_ordinal', False)
+    num_classes = config['num_classes']
+    if isinstance(teacher_weights, str):
+        teacher_weights = [teacher_weights]
+
+    cuda_available = torch.cuda.is_available()
+    if requirecuda and not cuda_available:
+        raise RuntimeError("CUDA is not available but requirecuda=True. "
+                           "Check GPU allocation and driver/module setup.")
+    device = torch.device('cuda' if cuda_available else 'cpu')
+
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+
+
+    # Ensemble probabilities: the soft targets
+    print(f'Ensemble of {len(teacher_weights)} models: predicting soft targets...')
+    probs_path = predict_unet_map(patches_dir, teacher_weights, config_path, requirecuda=requirecuda,
+                                  cache_dir=cache_dir, cache_max_gb=cache_max_gb, chunk_size=chunk_size)
+
+    with open(os.path.join(patches_dir, 'map_metadata.json'), 'r') as f:
+        map_meta = json.load(f)
+    site = map_meta['site'].upper()
+    patches_path = os.path.join(patches_dir, f'{site}_map_patches.npy')
+    if os.path.exists(patches_path):
+        patches = np.load(patches_path, mmap_mode='r')
+    else:
+        from tile_unet_map import MapPatchReader
+        patches = MapPatchReader(patches_dir, os.path.join(patches_dir, map_meta['stack_file']),
+                                 map_meta['patch_size'])
+    nodata_path = os.path.join(patches_dir, f'{site}_map_nodata.npy')
+    nodata = np.load(nodata_path, mmap_mode='r') if os.path.exists(nodata_path) else None
+    data = DistillData(patches, np.load(probs_path, mmap_mode='r'), nodata)
+
+
+    # Patches with any valid pixels, split into training and held-out sets
+    n_patches = patches.shape[0]
+    usable = np.arange(n_patches) if nodata is None else \
+        np.flatnonzero(np.asarray(nodata).reshape(n_patches, -1).any(axis=1))
+    usable = rng.permutation(usable)
+    if max_patches is not None:
+        usable = usable[:int(max_patches)]
+    n_hold = max(1, int(round(holdout_frac * len(usable))))
+    hold_idx, train_idx = usable[:n_hold], usable[n_hold:]
+    print(f'Distilling on {len(train_idx)} patches; {len(hold_idx)} held out for agreement')
+
+
+    # Student
+    teacher_encoder = config['encoder_name']
+    if encoder_name is None:
+        encoder_name = teacher_encoder
+    same_encoder = encoder_name == teacher_encoder
+    model = build_unet(encoder_name, config['in_channels'], num_classes, use_ordinal=use_ordinal,
+                       encoder_weights=None if same_encoder else encoder_weights)
+    if same_encoder:
+        model.load_state_dict(load_state_dict(teacher_weights[0]))
+    model = model.to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    print(f'Student: {encoder_name}' + (f' (from {os.path.basename(teacher_weights[0])})' if same_encoder else
+                                        f', teacher {teacher_encoder}'))
+
+
+    os.makedirs(output_dir, exist_ok=True)
+    history = []
+    for epoch in range(n_epochs):
+        model.train()
+        order = rng.permutation(train_idx)
+        losses = []
+        for start in range(0, len(order), batch_size):
+            x, y, v = data.batch(order[start:start + batch_size], device)
+            k = int(rng.integers(4))                                            # same dihedral transform for inputs and targets
+            x, y, v = (torch.rot90(t, k, dims=[-2, -1]) for t in (x, y, v))
+            if rng.random() < 0.5:
+                x, y, v = (torch.flip(t, dims=[-1]) for t in (x, y, v))
+
+            optimizer.zero_grad()
+            loss = soft_target_loss(model(x), y, v, use_ordinal)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=gradient_clip_max_norm)
+            optimizer.step()
+            losses.append(loss.item())
+
+        ev = evaluate_student(model, data, hold_idx, batch_size, device, use_ordinal, num_classes)
+        history.append({'epoch': epoch + 1, 'train_loss': float(np.mean(losses)) if losses else float('nan'),
+                        'agreement': ev['agreement'], 'mean_abs_prob_diff': ev['mean_abs_prob_diff']})
+        print(f'Epoch {epoch + 1}/{n_epochs}: loss {history[-1]["train_loss"]:.4f}, '
+              f'agreement {ev["agreement"]:.2%}, mean |dp| {ev["mean_abs_prob_diff"]:.4f}')
+
+
+    # Agreement (from the last epoch) and speedup on held-out patches
+    if not history:
+        ev = evaluate_student(model, data, hold_idx, batch_size, device, use_ordinal, num_classes)
+    time_idx = hold_idx[:timing_patches]
+    student_sec = evaluate_student(model, data, time_idx, batch_size, device, use_ordinal,
+                                   num_classes)['seconds_per_patch']
+    teacher_sec = time_ensemble(teacher_weights, config, data, time_idx, batch_size, device, use_ordinal)
+    speedup = teacher_sec / student_sec if student_sec > 0 else float('nan')
+    print(f'Student vs ensemble: {ev["agreement"]:.2%} pixel agreement; '
+          f'{teacher_sec * 1000:.1f} vs {student_sec * 1000:.1f} ms per patch ({speedup:.1f}x faster)')
+
+
+    # Save weights and a standard config (teacher's, with the student's encoder)
+    model_path = os.path.join(output_dir, f'unet_{site}_final.pth')
+    student_config_path = os.path.join(output_dir, f'unet_{site}_config.json')
+    torch.save(model.state_dict(), model_path)
+    with open(student_config_path, 'w') as f:
+        json.dump(dict(config, encoder_name=encoder_name), f, indent=2)
+
+    with open(os.path.join(output_dir, 'distill_metrics.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(history[0].keys()) if history else ['epoch'])
+        writer.writeheader()
+        writer.writerows(history)
+
+    report = {
+        'teacher_weights': [os.path.abspath(w) for w in teacher_weights],
+        'teacher_encoder': teacher_encoder,
+        'student_encoder': encoder_name,
+        'n_train_patches': int(len(train_idx)),
+        'n_holdout_patches': int(len(hold_idx)),
+        'n_epochs': n_epochs,
+        'agreement': ev['agreement'],
+        'mean_abs_prob_diff': ev['mean_abs_prob_diff'],
+        'class_agreement': ev['class_agreement'],
+        'ensemble_sec_per_patch': teacher_sec,
+        'student_sec_per_patch': student_sec,
+        'speedup': speedup,
+    }
+    with open(os.path.join(output_dir, 'distill_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if hasattr(patches, 'close'):
+        patches.close()
+
+    return {'model_path': model_path, 'config_path': student_config_path,
+            'agreement': ev['agreement'], 'speedup': speedup}
@@ -0,0 +1,139 @@
+"""
+Cached encoder features for frozen-encoder U-Net training
+
+With the smp encoder frozen (weights fixed, BatchNorm in eval mode), the
+encoder's feature pyramid for a training patch depends only on the patch and
+its augmentation. MaskedPatchDataset's rotations and flips produce one of the
+8 dihedral transforms of each patch, so the encoder output for every
+(patch, transform) pair is computed once, the first time it's drawn, and
+stored in memory-mapped .npy files (float16, one file per pyramid level).
+Later epochs read the features back and run only the decoder and head.
+Level 0 of smp's pyramid is the input patch itself, which the decoder
+discards, so it isn't stored: the augmented batch stands in for it.
+
+The cache holds as many patches as fit under a size cap; patches beyond it
+have their features computed each time. Cached and freshly computed features
+are both rounded to float16, so results don't depend on what was cached.
+"""
+
+import os
+import shutil
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+
+def _dihedral_table():
+    """Map each (rotation k, hflip, vflip) combination to one of the 8 dihedral transforms"""
+    corners = torch.arange(4).reshape(1, 2, 2)
+    seen, table = {}, {}
+    for k in range(4):
+        for h in (0, 1):
+            for v in (0, 1):
+                x = torch.rot90(corners, k, dims=[1, 2])
+                if h:
+                    x = torch.flip(x, dims=[2])
+                if v:
+                    x = torch.flip(x, dims=[1])
+                key = tuple(x.flatten().tolist())
+                table[(k, h, v)] = seen.setdefault(key, len(seen))
+    return table
+
+
+DIHEDRAL = _dihedral_table()                                   # (k, hflip, vflip) -> 0..7
+
+
+class FeatureCache:
+    """
+    On-disk cache of a frozen encoder's features, keyed by patch and dihedral transform.
+
+    Installs itself in front of the encoder: prepare() looks up (or computes
+    and stores) the features for a batch, and the model's next forward pass
+    receives them instead of running the encoder, so decoder and head code
+    paths are exactly those of the full model.
+
+    Args:
+        model: smp.Unet with a frozen encoder (not wrapped in DataParallel)
+        cache_dir: Directory for the memory-mapped feature files
+        n_patches: Number of training patches
+        sample_shape: (C, H, W) of one patch
+        device: Training device
+        max_gb: Size cap; patches beyond it are not cached
+    """
+
+    def __init__(self, model, cache_dir, n_patches, sample_shape, device, max_gb=20):
+        self.encoder = model.encoder
+        self.encode = model.encoder.forward                     # the real encoder
+        self.cache_dir = cache_dir
+        self.device = device
+        self.hits = 0
+        self.misses = 0
+
+        with torch.no_grad():
+            shapes = [tuple(f.shape[1:]) for f in self.encode(torch.zeros((1,) + tuple(sample_shape), device=device))]
+        self.first = 1 if shapes[0] == tuple(sample_shape) else 0         # level 0 is the input: don't store it
+        shapes = shapes[self.first:]
+        per_patch = 8 * sum(int(np.prod(s)) for s in shapes) * 2                # 8 transforms, float16
+        self.n_cached = int(min(n_patches, (max_gb * 1024 ** 3) // per_patch))
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.levels = [open_memmap(os.path.join(cache_dir, f'level{l}.npy'), mode='w+', dtype=np.float16,
+                                   shape=(max(self.n_cached, 1), 8) + s)
+                       for l, s in enumerate(shapes, start=self.first)]
+        self.filled = np.zeros((max(self.n_cached, 1), 8), dtype=bool)
+
+        print(f'Encoder feature cache: {self.n_cached} of {n_patches} patches x 8 transforms '
+              f'({self.n_cached * per_patch / 1024 ** 3:.1f} GB at {per_patch / 1024 ** 2:.1f} MB per patch)')
+
+        self._pending = None
+        model.encoder.forward = self._forward
+
+    def _forward(self, x):
+        if self._pending is not None:
+            features, self._pending = self._pending, None
+            return features
+        return self.encode(x)
+
+    def prepare(self, patches, index, transform):
+        """
+        Features for the next forward pass on this (already augmented) batch.
+
+        Args:
+            patches: [B, C, H, W] augmented patches on device
+            index: [B] patch indices into the training set
+            transform: [B] dihedral transform ids (0..7)
+        """
+        index = index.tolist()
+        transform = transform.tolist()
+        hit = [i < self.n_cached and self.filled[i, t] for i, t in zip(index, transform)]
+
+        features = [torch.empty((len(index),) + tuple(level.shape[2:]), dtype=torch.float16)
+                    for level in self.levels]
+        for j, (i, t) in enumerate(zip(index, transform)):
+            if hit[j]:
+                for level, f in zip(self.levels, features):
+                    f[j] = torch.from_numpy(np.asarray(level[i, t]))
+
+        miss = [j for j, h in enumerate(hit) if not h]
+        if miss:
+            with torch.no_grad():
+                computed = [f.half().cpu() for f in self.encode(patches[miss])[self.first:]]
+            for f, c in zip(features, computed):
+                f[miss] = c
+            for m, j in enumerate(miss):
+                i, t = index[j], transform[j]
+                if i < self.n_cached:
+                    for level, c in zip(self.levels, computed):
+                        level[i, t] = c[m].numpy()
+                    self.filled[i, t] = True
+
+        self.hits += sum(hit)
+        self.misses += len(miss)
+        self._pending = [patches] * self.first + [f.to(self.device).float() for f in features]
+
+    def close(self):
+        """Restore the encoder and delete the cache files"""
+        self.encoder.forward = self.encode
+        self.levels = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
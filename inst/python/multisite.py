@@ -0,0 +1,202 @@
+"""
+Train one model on several sites' patch exports without concatenating them
+
+A regional model draws on the per-site exports from unet_prep, each a
+`{site}_{split}_{patches,labels,masks}.npy` set in its own data_dir. Rather
+than building a combined export, each split of each source is opened
+memory-mapped and indexed as one virtual dataset: a global patch index maps
+to (source, local index), and patches are read from disk as they are drawn.
+Class pixel counts are accumulated source by source, a chunk of patches at a
+time, so no combined array is ever built. Optional per-site sampling weights
+set how often each site is drawn, independent of how many patches it has.
+Per-site validation and test CCR of the final model are reported in
+site_metrics.csv.
+"""
+
+import os
+import csv
+import json
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, WeightedRandomSampler
+
+
+def read_sources(sources, in_channels=None):
+    """
+    Normalize and validate training sources.
+
+    Args:
+        sources: List of (site, data_dir) pairs, or of dicts with 'site' and
+            'data_dir'
+        in_channels: Optional expected number of input channels
+
+    Returns:
+        List of dicts with site, data_dir and in_channels (from each
+        `{site}_metadata.json`), all with the same in_channels
+
+    Raises:
+        ValueError if in_channels differ between sources (or from in_channels)
+    """
+    out = []
+    for s in sources:
+        site, data_dir = (s['site'], s['data_dir']) if isinstance(s, dict) else s
+        with open(os.path.join(data_dir, f"{site}_metadata.json")) as f:
+            channels = int(json.load(f)['in_channels'])
+        out.append({'site': site, 'data_dir': data_dir, 'in_channels': channels})
+    found = {s['in_channels'] for s in out}
+    if len(found) > 1 or (in_channels is not None and found != {int(in_channels)}):
+        detail = ', '.join(f"{s['site']}={s['in_channels']}" for s in out)
+        raise ValueError(f"Sources must all have {in_channels or 'the same number of'} input channels; got {detail}")
+    return out
+
+
+def open_split(data_dir, site, dataset):
+    """Memory-mapped patches, labels and masks for one split of one source"""
+    return tuple(np.load(os.path.join(data_dir, f"{site}_{dataset}_{part}.npy"), mmap_mode='r')
+                 for part in ('patches', 'labels', 'masks'))
+
+
+def split_class_counts(splits, num_classes, chunk=256):
+    """
+    Labeled pixel counts per class, and label values present, across sources.
+
+    Args:
+        splits: One (patches, labels, masks) per source
+        num_classes: Number of classes
+        chunk: Patches read at a time
+
+    Returns:
+        ((num_classes,) float pixel counts, sorted label values other than 255)
+    """
+    counts = np.zeros(num_classes)
+    values = set()
+    for _, labels, masks in splits:
+        for s in range(0, len(labels), chunk):
+            lab = np.asarray(labels[s:s + chunk])
+            msk = np.asarray(masks[s:s + chunk]) == 1
+            counts += np.bincount(lab[msk & (lab < num_classes)].ravel(), minlength=num_classes)[:num_classes]
+            values.update(np.unique(lab[lab != 255]).tolist())
+    return counts, sorted(int(v) for v in values)
+
+
+class _VirtualPatches:
+    """Shape of the concatenated patches, in [N, C, H, W] order as MaskedPatchDataset.patches"""
+
+    def __init__(self, splits):
+        n = sum(len(p) for p, _, _ in splits)
+        h, w, c = splits[0][0].shape[1:]
+        self.shape = torch.Size((n, c, h, w))
+
+
+def _dataset_base():
+    from train_unet import MaskedPatchDataset                  # deferred: train_unet imports this module
+    return MaskedPatchDataset
+
+
+class MultiSiteDataset(torch.utils.data.Dataset):
+    """
+    Lazy, memory-mapped concatenation of one split over several sources.
+
+    Indexing, augmentation and return values are those of
+    train_unet.MaskedPatchDataset; only patch storage differs.
+    """
+
+    def __init__(self, splits, sites, augment=True, return_index=False, rng=None):
+        """
+        Args:
+            splits: One (patches, labels, masks) per source, e.g. from open_split()
+            sites: Site code of each source
+            augment, return_index, rng: As for MaskedPatchDataset
+        """
+        import random
+        self.splits = splits
+        self.sites = list(sites)
+        self.sizes = np.array([len(p) for p, _, _ in splits], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.patches = _VirtualPatches(splits)
+        self.augment = augment
+        self.return_index = return_index
+        self.rng = rng if rng is not None else random
+
+        print(f"Multi-site dataset created: {len(self)} patches, shape {tuple(self.patches.shape[1:])}")
+        for site, n in zip(self.sites, self.sizes):
+            print(f"  {site}: {n} patches")
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def source_of(self, idx):
+        """Source index and local patch index for a global index"""
+        s = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        return s, idx - int(self.offsets[s])
+
+    def _get(self, idx):
+        s, i = self.source_of(idx)
+        patches, labels, masks = self.splits[s]
+        patch = torch.from_numpy(np.array(patches[i], dtype=np.float32)).permute(2, 0, 1)
+        label = torch.from_numpy(np.array(labels[i], dtype=np.int64))
+        mask = torch.from_numpy(np.array(masks[i], dtype=np.float32))
+        return patch, label, mask
+
+    def __getitem__(self, idx):
+        return _dataset_base().__getitem__(self, idx)
+
+    def site_subset(self, s, augment=None):
+        """Dataset of source s alone (no augmentation by default)"""
+        return MultiSiteDataset([self.splits[s]], [self.sites[s]],
+                                augment=False if augment is None else augment)
+
+
+def site_sampler(dataset, site_weights, generator=None):
+    """
+    Sampler drawing each site in proportion to its weight, whatever its size.
+
+    Args:
+        dataset: MultiSiteDataset
+        site_weights: One weight per source, or a dict of site: weight
+            (sites not named get 1)
+        generator: torch.Generator for the draws
+
+    Returns:
+        WeightedRandomSampler over len(dataset) draws per epoch, with replacement
+    """
+    if isinstance(site_weights, dict):
+        site_weights = [float(site_weights.get(s, 1.0)) for s in dataset.sites]
+    site_weights = np.atleast_1d(np.asarray(site_weights, dtype=np.float64))
+    if len(site_weights) != len(dataset.sites) or (site_weights < 0).any() or site_weights.sum() == 0:
+        raise ValueError(f"site_weights must be {len(dataset.sites)} non-negative weights, not all zero")
+    per_patch = np.repeat(site_weights / np.maximum(dataset.sizes, 1), dataset.sizes)
+    return WeightedRandomSampler(torch.as_tensor(per_patch, dtype=torch.double), len(dataset),
+                                 replacement=True, generator=generator)
+
+
+def site_metrics(model, datasets, validate_fn, batch_size, path):
+    """
+    Validation and test CCR of the final model for each site.
+
+    Args:
+        model: Trained model
+        datasets: Dict of split name ('validate', 'test') to MultiSiteDataset
+        validate_fn: Function (model, loader) -> (loss, ccr, class_ccr)
+        batch_size: Evaluation batch size
+        path: site_metrics.csv to write
+
+    Returns:
+        List of per-site dicts (site, n_<split>, <split>_ccr)
+    """
+    sites = next(iter(datasets.values())).sites
+    rows = [{'site': site} for site in sites]
+    for name, dataset in datasets.items():
+        for s, row in enumerate(rows):
+            subset = dataset.site_subset(s)
+            row[f'n_{name}'] = len(subset)
+            row[f'{name}_ccr'] = validate_fn(model, DataLoader(subset, batch_size=batch_size))[1] \
+                if len(subset) > 0 else float('nan')
+    with open(path, 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        w.writeheader()
+        w.writerows(rows)
+    print("\nPer-site CCR (final model):")
+    for row in rows:
+        print('  ' + row['site'] + ': ' + ', '.join(f"{k[:-4]} {v:.2%}" for k, v in row.items() if k.endswith('_ccr')))
+    return rows
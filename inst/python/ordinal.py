@@ -0,0 +1,213 @@
+"""
+CORN ordinal regression kernels for dense U-Net outputs
+
+Shared by train_unet.py, predict_unet.py, predict_unet_map.py and
+distill_unet.py. CORN (Conditional Ordinal Regression with Neural Networks)
+uses K-1 conditional logits for K ordered classes; sigmoid(logit_k) is
+P(y > k | y >= k).
+
+Everything works directly on [B, K-1, H, W] maps with a pixel mask: no
+permute/reshape to [B*H*W, K-1], no boolean gather of labeled pixels, and no
+per-threshold or per-class Python loops. Results match coral_pytorch's
+corn_loss and corn_label_from_logits (see check_parity); benchmark() times
+the two loss paths.
+
+Run as a script to print a parity check and benchmark:
+    python ordinal.py [--device cuda]
+"""
+
+import time
+import torch
+import torch.nn.functional as F
+
+
+def corn_loss_masked(logits, labels, valid):
+    """
+    Masked CORN loss on dense maps.
+
+    Threshold k is trained on the pixels with y >= k (target y > k), as in
+    coral_pytorch.losses.corn_loss; the summed binary cross-entropy over all
+    thresholds is divided by the number of (pixel, threshold) terms.
+
+    Args:
+        logits: [B, K-1, H, W] CORN logits
+        labels: [B, H, W] integer class labels (any value where not valid)
+        valid: [B, H, W] bool mask of labeled pixels
+
+    Returns:
+        Scalar loss tensor (NaN if there are no valid pixels)
+    """
+    k = torch.arange(logits.shape[1], device=logits.device).view(1, -1, 1, 1)
+    y = labels.long().unsqueeze(1)                                          # [B, 1, H, W]
+    eligible = valid.bool().unsqueeze(1) & (y >= k)                        # [B, K-1, H, W]
+    target = (y > k).to(logits.dtype)
+
+    log_p = F.logsigmoid(logits)
+    bce = log_p * target + (log_p - logits) * (1 - target)                 # log-likelihood of each binary task
+    bce = torch.where(eligible, bce, torch.zeros_like(bce))
+    return -bce.sum() / eligible.sum()
+
+
+def corn_cumulative(logits, dim=1):
+    """P(y > k) for k = 0..K-2: cumulative product of the conditional probabilities"""
+    return torch.cumprod(torch.sigmoid(logits), dim=dim)
+
+
+def corn_label(logits, dim=1):
+    """Predicted class: number of thresholds with P(y > k) > 0.5 (as corn_label_from_logits)"""
+    return (corn_cumulative(logits, dim) > 0.5).sum(dim=dim)
+
+
+def corn_probabilities(logits, dim=1):
+    """
+    Per-class probabilities from CORN logits.
+
+    P(y = k) = P(y >= k) - P(y >= k+1), with P(y >= 0) = 1.
+
+    Args:
+        logits: [B, K-1, H, W] CORN logits (thresholds along dim)
+
+    Returns:
+        [B, K, H, W] class probabilities, summing to 1 over dim
+    """
+    cum = corn_cumulative(logits, dim)                                     # P(y >= 1) .. P(y >= K-1)
+    edge_shape = list(cum.shape)
+    edge_shape[dim] = 1
+    ones = torch.ones(edge_shape, dtype=cum.dtype, device=cum.device)
+    ge = torch.cat([ones, cum], dim=dim)                                   # P(y >= k), k = 0..K-1
+    gt = torch.cat([cum, torch.zeros_like(ones)], dim=dim)                 # P(y >= k+1)
+    return ge - gt
+
+
+def corn_soft_loss_masked(logits, probs, valid):
+    """
+    Masked CORN loss against soft per-class targets, for distillation.
+
+    Threshold k's binary task is weighted by the target's P(y >= k) and has
+    target P(y > k | y >= k). With one-hot targets this is corn_loss_masked.
+
+    Args:
+        logits: [B, K-1, H, W] CORN logits
+        probs: [B, K, H, W] target class probabilities
+        valid: [B, H, W] bool mask of pixels to train on
+
+    Returns:
+        Scalar loss tensor (NaN if there are no valid pixels)
+    """
+    ge = torch.flip(torch.cumsum(torch.flip(probs, dims=[1]), dim=1), dims=[1])   # P(y >= k), k = 0..K-1
+    weight, gt = ge[:, :-1], ge[:, 1:]                                     # P(y >= k), P(y > k) for each threshold
+    m = valid.unsqueeze(1).to(logits.dtype)
+
+    log_p = F.logsigmoid(logits)
+    ll = gt * log_p + (weight - gt) * (log_p - logits)                     # weight * log-likelihood of the binary task
+    return -(ll * m).sum() / (weight * m).sum()
+
+
+def _flat(logits, labels, valid):
+    """Labeled pixels as [n, K-1] logits and [n] labels, the layout coral_pytorch expects"""
+    C = logits.shape[1]
+    flat_valid = valid.reshape(-1).bool()
+    return logits.permute(0, 2, 3, 1).reshape(-1, C)[flat_valid], labels.reshape(-1)[flat_valid].long()
+
+
+def _example(num_classes, batch, size, labeled, device, seed=42):
+    g = torch.Generator().manual_seed(seed)
+    logits = torch.randn(batch, num_classes - 1, size, size, generator=g).to(device)
+    labels = torch.randint(0, num_classes, (batch, size, size), generator=g).to(device)
+    valid = (torch.rand(batch, size, size, generator=g) < labeled).to(device)
+    labels[~valid] = 255                                                   # unlabeled, as in training
+    return logits, labels, valid
+
+
+def check_parity(num_classes=5, batch=4, size=64, labeled=0.05, device='cpu'):
+    """
+    Compare these kernels with coral_pytorch on random data.
+
+    Returns:
+        Dict of maximum absolute differences for the loss, its gradient, and
+        the predicted labels (0 means identical), or None if coral_pytorch
+        isn't installed
+    """
+    try:
+        from coral_pytorch.losses import corn_loss
+        from coral_pytorch.dataset import corn_label_from_logits
+    except ImportError:
+        return None
+
+    logits, labels, valid = _example(num_classes, batch, size, labeled, device)
+
+    a = logits.clone().requires_grad_(True)
+    loss_dense = corn_loss_masked(a, labels, valid)
+    loss_dense.backward()
+
+    b = logits.clone().requires_grad_(True)
+    flat_logits, flat_labels = _flat(b, labels, valid)
+    loss_coral = corn_loss(flat_logits, flat_labels, num_classes=num_classes)
+    loss_coral.backward()
+
+    flat_all = logits.permute(0, 2, 3, 1).reshape(-1, num_classes - 1)
+    label_coral = corn_label_from_logits(flat_all).reshape(labels.shape)
+
+    return {
+        'loss': abs(loss_dense.item() - loss_coral.item()),
+        'grad': (a.grad - b.grad).abs().max().item(),
+        'labels': (corn_label(logits) != label_coral).sum().item(),
+        'probabilities_sum': (corn_probabilities(logits).sum(dim=1) - 1).abs().max().item(),
+    }
+
+
+def benchmark(num_classes=5, batch=8, size=256, labeled=0.05, device='cpu', reps=20):
+    """
+    Time forward + backward of the dense masked loss against the flatten,
+    gather and coral_pytorch.corn_loss path it replaces.
+
+    Returns:
+        Dict of mean seconds per call for 'dense' and (if coral_pytorch is
+        installed) 'coral'
+    """
+    logits, labels, valid = _example(num_classes, batch, size, labeled, device)
+    device = torch.device(device)
+
+    def timed(fn):
+        for _ in range(3):                                                 # warm-up
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return (time.perf_counter() - t0) / reps
+
+    def dense():
+        x = logits.clone().requires_grad_(True)
+        corn_loss_masked(x, labels, valid).backward()
+
+    times = {'dense': timed(dense)}
+
+    try:
+        from coral_pytorch.losses import corn_loss
+    except ImportError:
+        return times
+
+    def coral():
+        x = logits.clone().requires_grad_(True)
+        flat_logits, flat_labels = _flat(x, labels, valid)
+        corn_loss(flat_logits, flat_labels, num_classes=num_classes).backward()
+
+    times['coral'] = timed(coral)
+    return times
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='CORN kernel parity check and benchmark')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--classes', type=int, default=5)
+    args = parser.parse_args()
+
+    parity = check_parity(num_classes=args.classes, device=args.device)
+    print('Parity with coral_pytorch:', parity if parity is not None else 'coral_pytorch not installed')
+    times = benchmark(num_classes=args.classes, device=args.device)
+    print('Seconds per loss + backward:', {k: f'{v:.5f}' for k, v in times.items()})
@@ -7,17 +7,13 @@ Supports both categorical and ordinal regression models
 import numpy as np
 import torch
 import torch.nn as nn
-import segmentation_models_pytorch as smp
 import os
 
-# Try to import CORAL for ordinal predictions
-try:
-    from coral_pytorch.dataset import corn_label_from_logits
-    CORAL_AVAILABLE = True
-except ImportError:
-    CORAL_AVAILABLE = False
+from unet_models import get_model, load_config
+from ordinal import corn_label, corn_probabilities
 
-def predict_unet(model_file, data_dir, site, dataset='test'):
+def predict_unet(model_file, data_dir, site, dataset='test', result_mode='arrays', output_dir=None,
+                 config_site=None):
     """
     Load trained model and predict on test/validation data
     
@@ -26,44 +22,57 @@ def predict_unet(model_file, data_dir, site, dataset='test'):
         data_dir: Directory containing numpy files
         site: Site name (e.g., 'rr')
         dataset: Which dataset to predict on ('test' or 'validate')
+        result_mode: What to hand back to the caller
+            - 'arrays': full arrays (below)
+            - 'labeled': only the labeled pixels, as flat vectors. Avoids copying
+              the full [N, H, W] and [N, K, H, W] arrays through reticulate
+              when the caller only needs pixels where masks == 1.
+            - 'files': write outputs as .npy files in output_dir and return
+              their paths plus a small summary. Files can be memory-mapped
+              (np.load(..., mmap_mode='r')).
+        output_dir: Directory for result_mode='files' (default: data_dir)
+        config_site: Site the model was fit for, naming its config file, when
+            it differs from the data's site (a multi-site fit predicting one
+            of its sources). Default: site
     
     Returns:
-        Dictionary with:
+        For 'arrays', a dictionary with:
             - predictions: [N, H, W] array of predicted classes
             - labels: [N, H, W] array of true labels
             - masks: [N, H, W] array of masks (1=labeled, 0=unlabeled)
-            - probabilities: [N, num_classes, H, W] array of class probabilities (None for ordinal)
+            - probabilities: [N, num_classes, H, W] array of class probabilities
+              (for ordinal models, derived from the CORN conditional probabilities)
             - original_classes: list of original class numbers
             - config: full model configuration
+        For 'labeled', predictions, labels, and probabilities ([n_labeled,
+        num_classes]) for labeled pixels only, with
+        'index' giving each pixel's flat index into the [N, H, W] arrays.
+        For 'files', paths to the .npy files (same names as 'labeled', plus
+        full-array 'predictions_array' and 'probabilities_array'), with
+        original_classes, config, and summary.
+        Every mode includes 'summary': n_labeled and overall CCR.
     """
     
+    if result_mode not in ('arrays', 'labeled', 'files'):
+        raise ValueError(f"result_mode must be 'arrays', 'labeled', or 'files'; got '{result_mode}'")
+    
     # Load config — stored one level above the set directory, at the fit level
     fit_dir     = os.path.dirname(os.path.dirname(model_file))
-    config_path = os.path.join(fit_dir, f"unet_{site.upper()}_config.json")
+    config_path = os.path.join(fit_dir, f"unet_{(config_site or site).upper()}_config.json")
 
     if not os.path.exists(config_path):
         raise ValueError(f"Config file not found: {config_path}\n"
                         f"Expected at fit level: <model>/<result>/unet_<SITE>_config.json")
     
-    import json
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    config = load_config(config_path)
     
     print(f"Loaded model config: {config}")
     
     # Extract params
-    encoder_name = config['encoder_name']
-    encoder_weights = config['encoder_weights']
-    in_channels = config['in_channels']
     num_classes = config['num_classes']
     use_ordinal = config.get('use_ordinal', False)  # Default False for backward compatibility
     original_classes = config.get('original_classes', list(range(num_classes)))
     
-    # Validate ordinal mode
-    if use_ordinal and not CORAL_AVAILABLE:
-        raise ImportError("This model uses ordinal regression but coral_pytorch is not installed.\n"
-                         "Install with: pip install coral-pytorch")
-    
     print("="*60)
     print(f"Predicting with U-Net on {dataset} set")
     if use_ordinal:
@@ -76,9 +85,9 @@ def predict_unet(model_file, data_dir, site, dataset='test'):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Using device: {device}")
     
-    # Load data
+    # Load data (memory-mapped; batches are read as they're predicted)
     print(f"\nLoading {dataset} data from {data_dir}...")
-    patches = np.load(os.path.join(data_dir, f"{site}_{dataset}_patches.npy"))
+    patches = np.load(os.path.join(data_dir, f"{site}_{dataset}_patches.npy"), mmap_mode='r')
     labels = np.load(os.path.join(data_dir, f"{site}_{dataset}_labels.npy"))
     masks = np.load(os.path.join(data_dir, f"{site}_{dataset}_masks.npy"))
     
@@ -86,126 +95,93 @@ def predict_unet(model_file, data_dir, site, dataset='test'):
     print(f"  Labels: {labels.shape}")
     print(f"  Masks: {masks.shape}")
     
-    # Convert to torch tensors
-    patches_t = torch.from_numpy(patches).float()
-    patches_t = patches_t.permute(0, 3, 1, 2)  # [N, H, W, C] -> [N, C, H, W]
+    n_patches = patches.shape[0]
+    labeled = (masks == 1)
     
     print(f"  Total pixels: {labels.size:,}")
-    print(f"  Labeled pixels: {(masks == 1).sum():,}")
-    
-    # Build model - RESPECT ORDINAL MODE
-    print("\nBuilding model architecture...")
+    print(f"  Labeled pixels: {labeled.sum():,}")
     
+    # Build model (ordinal models have num_classes - 1 outputs) and load trained
+    # weights, reusing a cached copy if this model was loaded before
     if use_ordinal:
-        # Ordinal: num_classes - 1 outputs (cumulative thresholds)
-        model = smp.Unet(
-            encoder_name=encoder_name,
-            encoder_weights=None,  # Never use pretrained for prediction
-            in_channels=in_channels,
-            classes=num_classes - 1,  # CORAL convention
-        )
-        print(f"  Ordinal regression: {num_classes - 1} cumulative thresholds for {num_classes} classes")
+        print(f"\nOrdinal regression: {num_classes - 1} cumulative thresholds for {num_classes} classes")
     else:
-        # Standard: num_classes outputs
-        model = smp.Unet(
-            encoder_name=encoder_name,
-            encoder_weights=None,  # Never use pretrained for prediction
-            in_channels=in_channels,
-            classes=num_classes,
-        )
-        print(f"  Categorical classification: {num_classes} classes")
-    
-    # Load trained weights
+        print(f"\nCategorical classification: {num_classes} classes")
     print(f"Loading weights from: {model_file}")
-    state_dict = torch.load(model_file, map_location=device)
-    
-    # Handle DataParallel wrapper if present
-    if list(state_dict.keys())[0].startswith('module.'):
-        state_dict = {k.replace('module.', ''): v for k, v in state_dict.items()}
-    
-    model.load_state_dict(state_dict)
-    model = model.to(device)
-    model.eval()
+    model = get_model(model_file, config, device)
+    
+    # Full-size outputs: in memory for 'arrays', memory-mapped files for 'files'
+    keep_full = result_mode != 'labeled'
+    if result_mode == 'files':
+        output_dir = output_dir or data_dir
+        os.makedirs(output_dir, exist_ok=True)
+        prefix = os.path.join(output_dir, f"{site}_{dataset}_pred")
+        predictions = np.lib.format.open_memmap(f"{prefix}_predictions_array.npy", mode='w+',
+                                                dtype=np.uint8, shape=labels.shape)
+        probabilities = np.lib.format.open_memmap(f"{prefix}_probabilities_array.npy", mode='w+',
+                                                  dtype=np.float32,
+                                                  shape=(n_patches, num_classes) + labels.shape[1:])
+    elif keep_full:
+        predictions = np.zeros(labels.shape, dtype=np.int64)
+        probabilities = np.zeros((n_patches, num_classes) + labels.shape[1:], dtype=np.float32)
+    
+    # Labeled-pixel vectors, gathered batch by batch
+    labeled_preds = []
+    labeled_probs = []
     
     # Predict in batches
     print("\nPredicting...")
     batch_size = 8
-    n_batches = int(np.ceil(len(patches_t) / batch_size))
-    
-    all_predictions = []
-    all_probabilities = []
+    n_batches = int(np.ceil(n_patches / batch_size))
     
     with torch.no_grad():
         for i in range(n_batches):
             start_idx = i * batch_size
-            end_idx = min((i + 1) * batch_size, len(patches_t))
+            end_idx = min((i + 1) * batch_size, n_patches)
             
-            batch = patches_t[start_idx:end_idx].to(device)
+            batch = torch.from_numpy(np.ascontiguousarray(patches[start_idx:end_idx])).float()
+            batch = batch.permute(0, 3, 1, 2).to(device)  # [B, H, W, C] -> [B, C, H, W]
             outputs = model(batch)
             
             # Get predictions based on mode
             if use_ordinal:
-                # CORAL ordinal: convert logits to predicted class
-                # outputs: [B, num_classes-1, H, W]
-                B, C, H, W = outputs.shape
-                
-                # Reshape for CORAL function: [B*H*W, C]
-                outputs_flat = outputs.permute(0, 2, 3, 1).reshape(-1, C)
-                
-                # Get ordinal predictions: [B*H*W]
-                preds_flat = corn_label_from_logits(outputs_flat)
-                
-                # Reshape back: [B, H, W]
-                preds = preds_flat.reshape(B, H, W)
-                
-                # Note: Ordinal probabilities are cumulative, not direct class probs
-                # For simplicity, we don't compute them here (would need conversion)
-                # If needed, sigmoid(outputs) gives cumulative probabilities P(y <= k)
+                # CORN ordinal: outputs [B, num_classes-1, H, W] -> class and
+                # per-class probabilities [B, num_classes, H, W]
+                preds = corn_label(outputs)  # [B, H, W]
+                probs = corn_probabilities(outputs).cpu().numpy()
                 
             else:
                 # Standard categorical
                 # outputs: [B, num_classes, H, W]
-                probs = torch.softmax(outputs, dim=1)  # [B, num_classes, H, W]
+                probs = torch.softmax(outputs, dim=1).cpu().numpy()  # [B, num_classes, H, W]
                 preds = torch.argmax(outputs, dim=1)  # [B, H, W]
-                all_probabilities.append(probs.cpu().detach().numpy())
             
-            all_predictions.append(preds.cpu().detach().numpy())
+            preds = preds.cpu().numpy()
+            batch_labeled = labeled[start_idx:end_idx]
+            labeled_preds.append(preds[batch_labeled].astype(np.int16))
+            labeled_probs.append(probs.transpose(0, 2, 3, 1)[batch_labeled])  # [n, num_classes]
+            
+            if keep_full:
+                predictions[start_idx:end_idx] = preds
+                probabilities[start_idx:end_idx] = probs
             
             if (i + 1) % 10 == 0:
-                print(f"  Processed {end_idx}/{len(patches_t)} patches")
+                print(f"  Processed {end_idx}/{n_patches} patches")
     
-    # Concatenate results
-    predictions = np.concatenate(all_predictions, axis=0)
-    
-    if use_ordinal:
-        probabilities = None  # Ordinal probabilities not computed
-        print("\nNote: Probability maps not generated for ordinal models")
-    else:
-        probabilities = np.concatenate(all_probabilities, axis=0)
-    
-    print(f"\nPrediction complete!")
-    print(f"  Total labeled pixels: {(masks == 1).sum()}")
-    print(f"  Overall CCR: {((predictions[masks == 1] == labels[masks == 1]).sum() / (masks == 1).sum()):.2%}")
-    print(f"Final predictions shape: {predictions.shape}")
-    if probabilities is not None:
-        print(f"Final probabilities shape: {probabilities.shape}")
+    # Concatenate labeled-pixel results
+    labeled_preds = np.concatenate(labeled_preds) if labeled_preds else np.zeros(0, dtype=np.int16)
+    labeled_labels = labels[labeled].astype(np.int16)
+    labeled_index = np.flatnonzero(labeled)
+    labeled_probs = np.concatenate(labeled_probs) if labeled_probs else \
+        np.zeros((0, num_classes), dtype=np.float32)
     
     # Compute metrics on labeled pixels only
-    print(f"\nArray shapes:")
-    print(f"  predictions: {predictions.shape}")
-    print(f"  labels: {labels.shape}")
-    print(f"  masks: {masks.shape}")
-    
-    # Flatten for metrics
-    labeled_mask = (masks == 1).flatten()
-    labeled_preds = predictions.flatten()[labeled_mask]
-    labeled_labels = labels.flatten()[labeled_mask]
-    
-    # Overall accuracy
+    total = labeled_index.size
     correct = (labeled_preds == labeled_labels).sum()
-    total = labeled_mask.sum()
     overall_acc = correct / total if total > 0 else 0
     
+    print(f"\nPrediction complete!")
+    print(f"  Total labeled pixels: {total}")
     print(f"\nOverall CCR: {overall_acc:.2%}")
     
     # Per-class accuracy
@@ -221,11 +197,47 @@ def predict_unet(model_file, data_dir, site, dataset='test'):
     
     print("\n" + "="*60)
     
-    return {
-        'predictions': predictions,
-        'labels': labels,
-        'masks': masks,
-        'probabilities': probabilities,  # None for ordinal models
-        'original_classes': original_classes,
-        'config': config
+    summary = {'n_labeled': int(total), 'ccr': float(overall_acc)}
+    
+    if result_mode == 'arrays':
+        return {
+            'predictions': predictions,
+            'labels': labels,
+            'masks': masks,
+            'probabilities': probabilities,
+            'original_classes': original_classes,
+            'config': config,
+            'summary': summary
+        }
+    
+    if result_mode == 'labeled':
+        return {
+            'predictions': labeled_preds,
+            'labels': labeled_labels,
+            'probabilities': labeled_probs,
+            'index': labeled_index,
+            'original_classes': original_classes,
+            'config': config,
+            'summary': summary
+        }
+    
+    # result_mode == 'files'
+    predictions.flush()
+    probabilities.flush()
+    paths = {
+        'predictions_array': f"{prefix}_predictions_array.npy",
+        'probabilities_array': f"{prefix}_probabilities_array.npy",
+        'predictions': f"{prefix}_predictions.npy",
+        'labels': f"{prefix}_labels.npy",
+        'probabilities': f"{prefix}_probabilities.npy",
+        'index': f"{prefix}_index.npy",
     }
+    np.save(paths['predictions'], labeled_preds)
+    np.save(paths['labels'], labeled_labels)
+    np.save(paths['index'], labeled_index)
+    np.save(paths['probabilities'], labeled_probs)
+    del predictions, probabilities
+    print(f"Results written to {output_dir}")
+    
+    paths.update({'original_classes': original_classes, 'config': config, 'summary': summary})
+    return paths
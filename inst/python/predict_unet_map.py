@@ -1,71 +1,409 @@
 """
 Predict U-Net on map patches for wall-to-wall mapping.
 
-Loads patches from numpy, predicts in batches, and saves class probabilities.
+Loads patches from numpy (or cuts them from the input stack GeoTIFF when prep
+didn't write a patch file), predicts in batches, and saves class probabilities.
 Supports both categorical and ordinal regression (CORN) models.
 Called from R via reticulate.
 """
 
 import torch
 import numpy as np
+import hashlib
 import json
 import os
-import segmentation_models_pytorch as smp
+import time
+import shutil
+from numpy.lib.format import open_memmap
+
+from unet_models import get_model, load_config
+from ordinal import corn_probabilities
+
+
+class PredictionCache:
+    """Content-addressed on-disk cache of per-patch, per-model class probabilities.
+
+    Entries are keyed by a hash of the input patch plus a hash of the model
+    weights and config, so a rerun after a clip change, a small mosaic fix, or
+    a re-prep with the same patch grid only predicts patches whose contents
+    actually changed. One float32 (K, H, W) array is stored per patch per model
+    under `<cache_dir>/<model_key>/<patch_key>.npy`. Entries are touched on
+    every hit. The cache's size on disk is tracked as entries are written, and
+    whenever it passes `max_gb` the least recently used entries are evicted
+    down to `LOW_WATER` of the cap, so the cap holds during a run, not just at
+    the end of it.
+    """
 
+    LOW_WATER = 0.9                                              # evict to this fraction of max_gb
+
+    def __init__(self, cache_dir, max_gb=20):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = self.evict()                                 # bytes on disk, kept current by put()
+
+    @staticmethod
+    def model_key(weights_path, config):
+        """Hash of the model weights file plus its (canonicalized) config"""
+        h = hashlib.sha1()
+        with open(weights_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                h.update(block)
+        h.update(json.dumps(config, sort_keys=True).encode())
+        return h.hexdigest()[:24]
+
+    @staticmethod
+    def patch_key(patch):
+        """Hash of one input patch (H, W, C), independent of memory layout"""
+        patch = np.ascontiguousarray(patch, dtype=np.float32)
+        h = hashlib.sha1(patch.tobytes())
+        h.update(str(patch.shape).encode())
+        return h.hexdigest()
+
+    def _path(self, model_key, patch_key):
+        return os.path.join(self.cache_dir, model_key, patch_key + '.npy')
+
+    def get(self, model_key, patch_key):
+        """Return cached probabilities, or None on a miss"""
+        path = self._path(model_key, patch_key)
+        try:
+            probs = np.load(path)
+        except (OSError, ValueError):                            # missing or truncated entry
+            self.misses += 1
+            return None
+        os.utime(path)                                           # mark as recently used
+        self.hits += 1
+        return probs
+
+    def put(self, model_key, patch_key, probs):
+        """Store probabilities for one patch (written atomically), evicting if over max_gb"""
+        if self.max_bytes <= 0:                                  # nothing fits; don't cache
+            return
+        path = self._path(model_key, patch_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(probs, dtype=np.float32))
+        os.replace(tmp, path)
+        self.size += os.path.getsize(path) - old
+        if self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * self.LOW_WATER))
+
+    def evict(self, target=None):
+        """Delete least recently used entries until the cache is under target bytes (default max_gb)
+
+        Returns:
+            Bytes left on disk
+        """
+        if target is None:
+            target = self.max_bytes
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            os.remove(path)
+            total -= size
+            self.evicted += 1
+        self.size = total
+        return total
+
+    def report(self):
+        """Hit/miss summary as a dict"""
+        n = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n if n > 0 else 0.0,
+            'evicted': self.evicted,
+        }
+
+
+def config_hash(config):
+    """Hash of a model config (canonicalized JSON)"""
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:24]
+
+
+def patches_signature(patches_dir, site, map_meta):
+    """Size and mtime of the map inputs, so a re-prep invalidates a prediction manifest"""
+    sig = {}
+    for name in (f'{site}_map_patches.npy', map_meta.get('stack_file'), 'patch_origins.csv'):
+        if name is not None and os.path.exists(os.path.join(patches_dir, name)):
+            st = os.stat(os.path.join(patches_dir, name))
+            sig[name] = [st.st_size, st.st_mtime_ns]
+    return sig
+
+
+class ChunkManifest:
+    """Durable record of map prediction progress, for resuming killed jobs.
+
+    Patches are predicted in fixed-size chunks. A chunk's averaged
+    probabilities are flushed to the output memmaps before the chunk is
+    recorded as done in the manifest (written atomically), so a restart with
+    the same arguments skips finished chunks and gives output identical to an
+    uninterrupted run. Within a chunk, the running sum over ensemble members
+    is saved after each member (with the list of members it includes), so a
+    restart also skips finished members. The manifest's key (patch inputs,
+    chunk size, model and config hashes) must match exactly to resume;
+    otherwise prediction starts over.
+    """
 
-def corn_probabilities(logits):
-    """Convert CORN ordinal logits to per-class probabilities.
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.done = set()
+        self.partial_dir = os.path.join(os.path.dirname(path), 'prediction_chunks')
+
+    def resume(self, *outputs):
+        """Pick up a prior manifest for the same inputs whose outputs still exist"""
+        try:
+            with open(self.path, 'r') as f:
+                prior = json.load(f)
+        except (OSError, ValueError):
+            prior = None
+        if prior is not None and prior.get('key') == self.key and all(os.path.exists(o) for o in outputs):
+            self.done = set(prior['done'])
+            return True
+        if prior is not None:
+            print('Prediction manifest is for different inputs or models; starting over')
+        self.done = set()
+        shutil.rmtree(self.partial_dir, ignore_errors=True)
+        return False
+
+    def save(self):
+        """Write the manifest atomically"""
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': self.key, 'done': sorted(self.done),
+                       'complete': len(self.done) == self.n_chunks}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    @property
+    def n_chunks(self):
+        return (self.key['n_patches'] + self.key['chunk_size'] - 1) // self.key['chunk_size']
+
+    def _partial_path(self, c):
+        return os.path.join(self.partial_dir, f'chunk_{c:06d}.npz')
+
+    def load_partial(self, c, shape, votes_shape=None):
+        """Running member sum, member indices, and (with votes_shape) per-class
+        vote counts for chunk c (zeros and [] if none saved)"""
+        try:
+            with np.load(self._partial_path(c)) as z:
+                votes = z['votes'].copy() if votes_shape is not None else None
+                return z['probs'].copy(), [int(m) for m in z['members']], votes
+        except (OSError, ValueError, KeyError):
+            votes = np.zeros(votes_shape, dtype=np.uint8) if votes_shape is not None else None
+            return np.zeros(shape, dtype=np.float32), [], votes
+
+    def save_partial(self, c, probs, members, votes=None):
+        """Save the running member sum for chunk c, atomically with its member list"""
+        os.makedirs(self.partial_dir, exist_ok=True)
+        path = self._partial_path(c)
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        extra = {} if votes is None else {'votes': votes}
+        np.savez(tmp, probs=probs, members=np.asarray(members, dtype=np.int64), **extra)
+        os.replace(tmp, path)
+
+    def commit(self, c):
+        """Record chunk c as complete (after its outputs have been flushed)"""
+        self.done.add(c)
+        self.save()
+        if os.path.exists(self._partial_path(c)):
+            os.remove(self._partial_path(c))
+
+
+def iter_probs(model, patches, idx, batch_size, device, use_ordinal):
+    """
+    Class probabilities from one model for patches idx, a batch at a time.
 
-    CORN (Conditional Ordinal Regression with Neural Networks) uses K-1
-    conditional logits for K classes. Each sigmoid(logit_k) gives the
-    conditional probability P(y > k | y >= k).
+    Yields:
+        (offset into idx, (batch, K, H, W) float32 probabilities,
+        (batch, H, W) uint8 argmax class, computed on the device)
+    """
+    with torch.no_grad():
+        for start in range(0, len(idx), batch_size):
+            # (batch, H, W, C) -> (batch, C, H, W) for PyTorch
+            batch = patches[idx[start:start + batch_size]].transpose(0, 3, 1, 2)
+            batch_tensor = torch.from_numpy(batch.astype(np.float32)).to(device)
 
-    Args:
-        logits: (batch, K-1, H, W) tensor of CORN logits
+            logits = model(batch_tensor)
 
-    Returns:
-        probs: (batch, K, H, W) tensor of per-class probabilities
+            if use_ordinal:
+                probs = corn_probabilities(logits)  # (batch, K, H, W)
+            else:
+                probs = torch.softmax(logits, dim=1)  # (batch, K, H, W)
+
+            yield start, probs.cpu().numpy(), probs.argmax(dim=1).to(torch.uint8).cpu().numpy()
+
+
+UNCERTAINTY_LAYERS = ('max_prob', 'margin', 'entropy', 'disagreement', 'ordinal_spread')
+UNCERTAINTY_SCALE = 100                                         # stored as uint8 percent; 255 = nodata when stitched
+
+
+def add_votes(votes, js, labels):
+    """Count one member's argmax class per pixel into (n, K, H, W) uint8 votes[js]"""
+    for k in range(votes.shape[1]):
+        votes[js, k] += labels == k
+
+
+def uncertainty_layers(probs, votes, n_votes, use_ordinal, device, batch_size=64):
     """
-    cond_probs = torch.sigmoid(logits)                         # P(y > k | y >= k)
-    B, Km1, H, W = cond_probs.shape
-    K = Km1 + 1
+    Per-pixel uncertainty layers from averaged class probabilities, on the device.
 
-    # Cumulative: P(y >= k) = product of conditional probs for j < k
-    # P(y >= 0) = 1 (always)
-    cum_ge = torch.ones(B, K, H, W, device=logits.device)
-    for k in range(1, K):
-        cum_ge[:, k] = cum_ge[:, k - 1] * cond_probs[:, k - 1]
+    Layers (all in [0, 1], scaled to uint8 0-UNCERTAINTY_SCALE):
+        max_prob: top class probability
+        margin: top class probability minus the runner-up's
+        entropy: Shannon entropy of the class probabilities, over log(K)
+        disagreement: fraction of ensemble members whose argmax differs from
+            the modal class (0 for a single model)
+        ordinal_spread: (CORN models only) standard deviation of the class
+            index under the probabilities, over its maximum (K - 1) / 2
+
+    Args:
+        probs: (n, K, H, W) averaged class probabilities
+        votes: (n, K, H, W) per-class member vote counts, or None
+        n_votes: (n,) number of members voting on each patch
+        use_ordinal: Include ordinal_spread
+        device: Torch device to compute on
+        batch_size: Patches per device batch
 
-    # Per-class: P(y = k) = P(y >= k) - P(y >= k+1)
-    probs = torch.zeros(B, K, H, W, device=logits.device)
-    for k in range(K - 1):
-        probs[:, k] = cum_ge[:, k] - cum_ge[:, k + 1]
-    probs[:, K - 1] = cum_ge[:, K - 1]                        # last class
+    Returns:
+        (n, L, H, W) uint8 layers, in UNCERTAINTY_LAYERS order (less
+        ordinal_spread for categorical models)
+    """
+    n, k = probs.shape[:2]
+    n_layers = len(UNCERTAINTY_LAYERS) - (0 if use_ordinal else 1)
+    out = np.empty((n, n_layers) + probs.shape[2:], dtype=np.uint8)
+    classes = torch.arange(k, dtype=torch.float32, device=device).view(1, k, 1, 1)
+    with torch.no_grad():
+        for s in range(0, n, batch_size):
+            p = torch.from_numpy(np.ascontiguousarray(probs[s:s + batch_size], dtype=np.float32)).to(device)
+            top = torch.topk(p, 2, dim=1).values
+            layers = [top[:, 0], top[:, 0] - top[:, 1],
+                      -(p * torch.log(p.clamp_min(1e-12))).sum(dim=1) / np.log(k)]
+            if votes is None:
+                layers.append(torch.zeros_like(top[:, 0]))
+            else:
+                v = torch.from_numpy(votes[s:s + batch_size]).to(device).float()
+                nv = torch.from_numpy(np.asarray(n_votes[s:s + batch_size], dtype=np.float32)).to(device)
+                layers.append(1 - v.max(dim=1).values / nv.clamp_min(1).view(-1, 1, 1))
+            if use_ordinal:
+                mean = (p * classes).sum(dim=1, keepdim=True)
+                sd = torch.sqrt((p * (classes - mean) ** 2).sum(dim=1))
+                layers.append(sd / ((k - 1) / 2))
+            u = torch.stack(layers, dim=1).clamp(0, 1) * UNCERTAINTY_SCALE
+            out[s:s + batch_size] = torch.round(u).to(torch.uint8).cpu().numpy()
+    return out
+
+
+def patch_confidence(probs, valid=None, stat='margin', quantile=0.05):
+    """
+    Per-patch confidence of a model's predictions, for cascade escalation.
 
-    return probs
+    Pixel confidence is the top class probability ('max_prob') or its margin
+    over the runner-up ('margin'); a patch's confidence is the given quantile
+    of its valid pixels' confidence, so a patch is only as confident as
+    nearly all of its pixels.
 
+    Args:
+        probs: (n, K, H, W) class probabilities
+        valid: Optional (n, H, W) mask, nonzero = valid pixel
+        stat: 'margin' or 'max_prob'
+        quantile: Quantile of pixel confidence taken per patch
 
-def predict_unet_map(patches_dir, model_weights, config_path, batch_size=64, requirecuda=True):
+    Returns:
+        (n,) confidence; inf for patches with no valid pixels (never escalated)
+    """
+    top = np.sort(probs, axis=1)
+    pixel = top[:, -1] - top[:, -2] if stat == 'margin' else top[:, -1]
+    conf = np.full(len(probs), np.inf)
+    for i in range(len(probs)):
+        v = pixel[i] if valid is None else pixel[i][np.asarray(valid[i]) > 0]
+        if v.size:
+            conf[i] = np.quantile(v, quantile)
+    return conf
+
+
+def predict_unet_map(patches_dir, model_weights, config_path, batch_size=64, requirecuda=True,
+                     cache_dir=None, cache_max_gb=20, chunk_size=1024, cascade_model=None,
+                     cascade_config_path=None, cascade_threshold=0.5, cascade_stat='margin',
+                     cascade_quantile=0.05, uncertainty=False, probs_dtype='float32', roi=None):
     """
     Predict on map patches and save probabilities.
 
     Handles both categorical (softmax) and ordinal (CORN) models.
     For ensembles, per-class probabilities are averaged across models
-    regardless of model type, then argmax is taken.
+    regardless of model type, then argmax is taken. Prediction runs chunk by
+    chunk (every model on a chunk, then the next chunk) and is resumable; see
+    ChunkManifest.
+
+    With cascade_model, each chunk is first predicted by that one (fast)
+    model alone. Patches whose confidence (patch_confidence()) is below
+    cascade_threshold are escalated to the ensemble; the rest keep the fast
+    model's probabilities. If the fast model is an ensemble member, its
+    predictions count toward the escalated patches' ensemble average. The
+    fraction escalated and the time saved against running every member on
+    every patch are printed and written to cascade_report.json.
+
+    With uncertainty, per-pixel uncertainty layers (see uncertainty_layers())
+    are computed on the device as each chunk is committed, from the averaged
+    probabilities and each member's argmax votes, and written as uint8 to
+    {SITE}_map_uncertainty.npy, (n, L, H, W), with layer names in
+    {SITE}_map_uncertainty.json, for assemble_unet_map() to stitch. In cascade
+    mode, patches the fast model kept have a single vote (disagreement 0).
+
+    With roi, only the patches intersecting it are predicted, and every output
+    goes to a patch set for the ROI's sub-raster in patches_dir/roi_<name>
+    (see roi_unet_map.py), which assemble_unet_map() assembles like a full set
+    and mosaic_roi() writes into the full map.
 
     Args:
         patches_dir: Directory with map patches numpy and metadata
         model_weights: Path to .pth weights file (or list of paths for ensemble)
         config_path: Path to model config JSON (from training)
         batch_size: Number of patches per GPU batch
+        cache_dir: Optional directory for the content-addressed prediction cache.
+            Patches whose contents and model are unchanged since a previous run
+            are read from the cache instead of being predicted. None disables it.
+        cache_max_gb: Size cap for the prediction cache; least recently used
+            entries are evicted beyond this
+        chunk_size: Patches per committed chunk. Results are flushed to disk
+            and recorded in prediction_manifest.json a chunk at a time, so a
+            killed job rerun with the same arguments only predicts missing chunks
+        cascade_model: Optional path to a fast model's .pth for cascade
+            inference (e.g. one CV fold, or a distilled model). None runs the
+            full ensemble on every patch
+        cascade_config_path: Config JSON for cascade_model; None uses config_path
+        cascade_threshold: Patches with confidence below this are escalated
+        cascade_stat: Pixel confidence, 'margin' (top-1 minus top-2
+            probability) or 'max_prob'
+        cascade_quantile: Quantile of pixel confidence used as a patch's confidence
+        uncertainty: Also write per-pixel uncertainty layers
+        probs_dtype: Storage type of the probabilities file, 'float32' or
+            'float16' (half the disk and assembly I/O; averaging is still
+            done in float32)
+        roi: Optional region of interest, a dict with 'bbox' ([xmin, ymin,
+            xmax, ymax] in map coordinates), 'polygon' ([[x, y], ...] in map
+            coordinates), or 'patches' (0-indexed patch indices), and
+            optionally 'name' (default 'roi')
 
     Returns:
         Path to saved probabilities numpy file
     """
 
     # Load model config
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    config = load_config(config_path)
 
     cuda_available = torch.cuda.is_available()
     print(f'CUDA available: {cuda_available}')
@@ -90,10 +428,25 @@ def predict_unet_map(patches_dir, model_weights, config_path, batch_size=64, req
 
     site = map_meta['site'].upper()
 
-    # Load patches
+    # Open patches: memory-mapped from the patch file, or (when prep didn't
+    # write one) cut on demand from the input stack GeoTIFF
     patches_path = os.path.join(patches_dir, f'{site}_map_patches.npy')
-    print(f'Loading patches from {patches_path}...')
-    patches = np.load(patches_path)                             # (n_patches, H, W, C)
+    if os.path.exists(patches_path):
+        print(f'Loading patches from {patches_path}...')
+        patches = np.load(patches_path, mmap_mode='r')          # (n_patches, H, W, C)
+    else:
+        from tile_unet_map import MapPatchReader
+        stack_path = os.path.join(patches_dir, map_meta['stack_file'])
+        print(f'Reading patches from input stack {stack_path}...')
+        patches = MapPatchReader(patches_dir, stack_path, map_meta['patch_size'])
+
+    # Predict just the patches touching an ROI, into their own patch set
+    out_dir = patches_dir
+    roi_idx = None
+    if roi is not None:
+        from roi_unet_map import prepare_roi, PatchSubset
+        out_dir, roi_idx = prepare_roi(patches_dir, map_meta, roi)
+        patches = PatchSubset(patches, roi_idx)
     n_patches = patches.shape[0]
     print(f'  {n_patches} patches, shape {patches.shape}')
 
@@ -104,79 +457,247 @@ def predict_unet_map(patches_dir, model_weights, config_path, batch_size=64, req
     print(f'Predicting with {n_models} model(s)')
 
     patch_size = patches.shape[1]
-
-    # Accumulate per-class probabilities across models
-    all_probs = np.zeros((n_patches, num_classes, patch_size, patch_size),
-                         dtype=np.float32)
-
-
-    os.makedirs(patches_dir, exist_ok=True)
-    progress_path = os.path.join(patches_dir, 'progress.txt')
+    chunk_size = max(1, int(chunk_size))
+    n_chunks = (n_patches + chunk_size - 1) // chunk_size
+
+    probs_path = os.path.join(out_dir, f'{site}_map_probs.npy')
+    preds_path = os.path.join(out_dir, f'{site}_map_preds.npy')
+    uncert_path = os.path.join(out_dir, f'{site}_map_uncertainty.npy')
+    if probs_dtype not in ('float32', 'float16'):
+        raise ValueError(f"probs_dtype must be 'float32' or 'float16', not {probs_dtype!r}")
+    cascade = None
+    if cascade_model is not None:
+        cascade_config = load_config(cascade_config_path) if cascade_config_path is not None else config
+        cascade = {
+            'path': os.path.abspath(cascade_model),
+            'hash': PredictionCache.model_key(cascade_model, cascade_config),
+            'threshold': cascade_threshold,
+            'stat': cascade_stat,
+            'quantile': cascade_quantile,
+        }
+        member = [os.path.abspath(w) for w in model_weights]
+        fast_member = member.index(cascade['path']) if cascade['path'] in member else None
+        print(f'Cascade: {os.path.basename(cascade_model)} first; patches with {cascade_stat} '
+              f'(q{cascade_quantile:g}) < {cascade_threshold} go to the ensemble')
+
+    manifest = ChunkManifest(os.path.join(out_dir, 'prediction_manifest.json'), {
+        'site': site,
+        'n_patches': n_patches,
+        'patch_shape': list(patches.shape[1:]),
+        'patches': patches_signature(patches_dir, site, map_meta),
+        'chunk_size': chunk_size,
+        'num_classes': num_classes,
+        'config_hash': config_hash(config),
+        'models': [{'path': os.path.abspath(w), 'hash': PredictionCache.model_key(w, config)}
+                   for w in model_weights],
+    })
+    if cascade is not None:
+        manifest.key['cascade'] = cascade
+    if probs_dtype != 'float32':
+        manifest.key['probs_dtype'] = probs_dtype
+    if roi_idx is not None:
+        manifest.key['roi'] = roi_idx.tolist()
+    if uncertainty:
+        manifest.key['uncertainty'] = True
+    resume = manifest.resume(probs_path, preds_path, *([uncert_path] if uncertainty else []))
+    if resume:
+        print(f'Resuming: {len(manifest.done)} / {n_chunks} chunks already complete')
+
+    # Outputs are written chunk by chunk to memory-mapped .npy files
+    mode = 'r+' if resume else 'w+'
+    all_probs = open_memmap(probs_path, mode=mode, dtype=np.dtype(probs_dtype),
+                            shape=(n_patches, num_classes, patch_size, patch_size))
+    all_preds = open_memmap(preds_path, mode=mode, dtype=np.int64,
+                            shape=(n_patches, patch_size, patch_size))
+    all_uncert = None
+    if uncertainty:
+        layer_names = [n for n in UNCERTAINTY_LAYERS if use_ordinal or n != 'ordinal_spread']
+        all_uncert = open_memmap(uncert_path, mode=mode, dtype=np.uint8,
+                                 shape=(n_patches, len(layer_names), patch_size, patch_size))
+        with open(os.path.join(out_dir, f'{site}_map_uncertainty.json'), 'w') as f:
+            json.dump({'layers': layer_names, 'scale': UNCERTAINTY_SCALE, 'n_models': n_models}, f, indent=2)
+    if not resume:
+        manifest.save()
+
+
+    os.makedirs(out_dir, exist_ok=True)
+    progress_path = os.path.join(out_dir, 'progress.txt')
     progress_file = open(progress_path, 'w')
-    
-    for m_idx, weights_path in enumerate(model_weights):
-        msg = f'Model {m_idx + 1} / {n_models}: {os.path.basename(weights_path)}'
+
+    cache = None
+    if cache_dir is not None:
+        cache = PredictionCache(cache_dir, max_gb=cache_max_gb)
+        print(f'Prediction cache: {cache_dir}')
+    model_keys = [m['hash'] for m in manifest.key['models']]
+    cache_report = [{'model': w, 'model_key': m['hash'], 'hits': 0, 'misses': 0}
+                    for w, m in zip(model_weights, manifest.key['models'])]
+
+    nodata = None
+    if cascade is not None:
+        nodata_path = os.path.join(out_dir, f'{site}_map_nodata.npy')
+        if os.path.exists(nodata_path):
+            nodata = np.load(nodata_path, mmap_mode='r')
+        cascade_stats = {'patches': 0, 'escalated': 0,
+                         'predicted': {}, 'seconds': {}}             # per model path: patches predicted, GPU seconds
+
+    def add_model_probs(weights_path, model_config, model_key, report, lo, local, out, patch_keys, votes=None):
+        """Add one model's probabilities for chunk-local patches `local` to out (and
+        its argmax to votes), from the cache where possible"""
+        todo = []
+        for j in local:
+            cached = cache.get(model_key, patch_keys[j]) if cache is not None else None
+            if cached is None:
+                todo.append(j)
+            else:
+                out[j] += cached
+                if votes is not None:
+                    add_votes(votes, [j], np.argmax(cached, axis=0)[None])
+        if cache is not None and report is not None:
+            report['hits'] += len(local) - len(todo)
+            report['misses'] += len(todo)
+
+        if todo:
+            # Build model (ordinal uses K-1 output channels) and load weights,
+            # reusing a cached copy if this model was loaded before
+            model = get_model(weights_path, model_config, device)
+            t0 = time.perf_counter()
+            for start, probs, labels in iter_probs(model, patches, [lo + j for j in todo], batch_size, device,
+                                                   model_config.get('use_ordinal', False)):
+                js = todo[start:start + len(probs)]
+                out[js] += probs
+                if votes is not None:
+                    add_votes(votes, js, labels)
+                if cache is not None:
+                    for k, j in enumerate(js):
+                        cache.put(model_key, patch_keys[j], probs[k])
+            if cascade is not None:
+                path = os.path.abspath(weights_path)
+                cascade_stats['predicted'][path] = cascade_stats['predicted'].get(path, 0) + len(todo)
+                cascade_stats['seconds'][path] = cascade_stats['seconds'].get(path, 0.0) + time.perf_counter() - t0
+        return len(todo)
+
+    # Chunk-major: every ensemble member predicts a chunk before it is committed.
+    # Models stay loaded in the shared LRU cache between chunks.
+    for c in range(n_chunks):
+        if c in manifest.done:
+            continue
+        lo, hi = c * chunk_size, min((c + 1) * chunk_size, n_patches)
+        msg = f'Chunk {c + 1} / {n_chunks} (patches {lo + 1}-{hi})'
         print(f'\n--- {msg} ---')
         progress_file.write(msg + '\n')
         progress_file.flush()
 
-        # Build model — ordinal uses K-1 output channels
-        model_classes = num_classes - 1 if use_ordinal else num_classes
-        model = smp.Unet(
-            encoder_name=config['encoder_name'],
-            encoder_weights=None,                               # weights loaded from file
-            in_channels=config['in_channels'],
-            classes=model_classes
-        )
-
-        # Load weights
-        state_dict = torch.load(weights_path, map_location=device, weights_only=True)
-        model.load_state_dict(state_dict)
-        model = model.to(device)
-        model.eval()
-
-        # Predict in batches
-        with torch.no_grad():
-            for start in range(0, n_patches, batch_size):
-                end = min(start + batch_size, n_patches)
-
-                # (batch, H, W, C) -> (batch, C, H, W) for PyTorch
-                batch = patches[start:end].transpose(0, 3, 1, 2)
-                batch_tensor = torch.from_numpy(batch.astype(np.float32)).to(device)
-
-                logits = model(batch_tensor)
-
-                if use_ordinal:
-                    probs = corn_probabilities(logits)          # (batch, K, H, W)
-                else:
-                    probs = torch.softmax(logits, dim=1)        # (batch, K, H, W)
-
-                all_probs[start:end] += probs.cpu().numpy()
-
-                if (end % (batch_size * 10) == 0) or (end == n_patches):
-                    print(f'  Processed {end} / {n_patches} patches')
-
-        del model
-        torch.cuda.empty_cache()
-
-
-    del patches
+        # Hash this chunk's patches once; keys are shared by every ensemble member
+        patch_keys = None
+        if cache is not None:
+            patch_keys = [PredictionCache.patch_key(patches[i]) for i in range(lo, hi)]
+
+        if cascade is not None:
+            # Fast model on the whole chunk; only unconfident patches go to the ensemble
+            chunk_probs = np.zeros((hi - lo, num_classes, patch_size, patch_size), dtype=np.float32)
+            chunk_votes = np.zeros(chunk_probs.shape, dtype=np.uint8) if uncertainty else None
+            n_votes = np.ones(hi - lo, dtype=np.int64)
+            add_model_probs(cascade_model, cascade_config, cascade['hash'], None, lo, range(hi - lo),
+                            chunk_probs, patch_keys, chunk_votes)
+            conf = patch_confidence(chunk_probs, None if nodata is None else nodata[lo:hi],
+                                    cascade_stat, cascade_quantile)
+            escalate = np.flatnonzero(conf < cascade_threshold).tolist()
+            if escalate:
+                if fast_member is None:
+                    chunk_probs[escalate] = 0
+                    if chunk_votes is not None:
+                        chunk_votes[escalate] = 0
+                for m_idx, weights_path in enumerate(model_weights):
+                    if m_idx != fast_member:
+                        add_model_probs(weights_path, config, model_keys[m_idx], cache_report[m_idx],
+                                        lo, escalate, chunk_probs, patch_keys, chunk_votes)
+                chunk_probs[escalate] /= n_models
+                n_votes[escalate] = n_models
+            cascade_stats['patches'] += hi - lo
+            cascade_stats['escalated'] += len(escalate)
+            print(f'  Escalated {len(escalate)} / {hi - lo} patches to the ensemble')
+        else:
+            # Partial sum over members, saved after each one so a restart resumes mid-chunk
+            shape = (hi - lo, num_classes, patch_size, patch_size)
+            chunk_probs, members, chunk_votes = manifest.load_partial(c, shape, shape if uncertainty else None)
+
+            for m_idx, weights_path in enumerate(model_weights):
+                if m_idx in members:
+                    continue
+
+                # Cached patches for this model are pulled first; only misses go to the GPU
+                n_predicted = add_model_probs(weights_path, config, model_keys[m_idx], cache_report[m_idx],
+                                              lo, range(hi - lo), chunk_probs, patch_keys, chunk_votes)
+
+                members.append(m_idx)
+                if len(members) < n_models:
+                    manifest.save_partial(c, chunk_probs, members, chunk_votes)
+                print(f'  Model {m_idx + 1} / {n_models}: {os.path.basename(weights_path)} '
+                      f'({n_predicted} predicted)')
+
+            # Average across models
+            chunk_probs /= n_models
+            n_votes = np.full(hi - lo, n_models)
+
+        # Commit the chunk
+        all_probs[lo:hi] = chunk_probs
+        all_preds[lo:hi] = np.argmax(chunk_probs, axis=1)   # hard predictions for quick inspection
+        if all_uncert is not None:
+            all_uncert[lo:hi] = uncertainty_layers(chunk_probs, chunk_votes, n_votes, use_ordinal,
+                                                   device, batch_size)
+            all_uncert.flush()
+        all_probs.flush()
+        all_preds.flush()
+        manifest.commit(c)
+
+
+    progress_file.close()
+
+    if cascade is not None and cascade_stats['patches'] > 0:
+        # Time saved: the members' measured seconds per patch, over every patch
+        # this run, against the time actually spent
+        rate = {p: cascade_stats['seconds'][p] / n for p, n in cascade_stats['predicted'].items() if n > 0}
+        fallback = rate.get(cascade['path'], 0.0)
+        full_secs = sum(rate.get(os.path.abspath(w), fallback) for w in model_weights) * cascade_stats['patches']
+        spent_secs = sum(cascade_stats['seconds'].values())
+        report = {
+            'cascade_model': cascade['path'],
+            'threshold': cascade_threshold,
+            'stat': cascade_stat,
+            'quantile': cascade_quantile,
+            'patches': cascade_stats['patches'],
+            'escalated': cascade_stats['escalated'],
+            'escalated_fraction': cascade_stats['escalated'] / cascade_stats['patches'],
+            'predicted': cascade_stats['predicted'],
+            'seconds': spent_secs,
+            'full_ensemble_seconds_est': full_secs,
+            'seconds_saved_est': full_secs - spent_secs,
+        }
+        print(f'\nCascade: escalated {report["escalated"]} / {report["patches"]} patches '
+              f'({report["escalated_fraction"]:.1%}); {spent_secs:.0f} s predicting vs ~{full_secs:.0f} s '
+              f'for the full ensemble (~{full_secs - spent_secs:.0f} s saved)')
+        with open(os.path.join(out_dir, 'cascade_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if cache is not None:
+        size_gb = cache.evict() / 1024 ** 3
+        summary = cache.report()
+        print(f'\nPrediction cache: {summary["hits"]} hits, {summary["misses"]} misses '
+              f'({summary["hit_rate"]:.1%} hit rate), {summary["evicted"]} evicted, '
+              f'{size_gb:.2f} GB on disk')
+        summary['cache_dir'] = cache_dir
+        summary['cache_gb'] = size_gb
+        summary['models'] = cache_report
+        with open(os.path.join(out_dir, 'prediction_cache_report.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if hasattr(patches, 'close'):
+        patches.close()
+    del patches, all_probs, all_preds, all_uncert
     import gc
     gc.collect()                                            # clean up memory
 
-    # Average across models
-    all_probs /= n_models
-
-    # Save probabilities
-    probs_path = os.path.join(patches_dir, f'{site}_map_probs.npy')
-    print(f'\nSaving probabilities to {probs_path}...')
-    np.save(probs_path, all_probs)
-
-    # Also save hard predictions for quick inspection
-    predictions = np.argmax(all_probs, axis=1)                 # (n_patches, H, W)
-    preds_path = os.path.join(patches_dir, f'{site}_map_preds.npy')
-    np.save(preds_path, predictions)
-
-    print(f'Prediction complete: {n_patches} patches, {n_models} model(s)')
+    print(f'Prediction complete: {n_patches} patches, {n_models} model(s); '
+          f'probabilities in {probs_path}')
 
     return probs_path
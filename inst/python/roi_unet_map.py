@@ -0,0 +1,240 @@
+"""
+Region-of-interest prediction on an existing map patch set
+
+Resolves an ROI (a bounding box or polygon in map coordinates, or a list of
+patch indices) against patch_origins.csv and the raster extent in
+map_metadata.json, and writes a self-contained patch set for just the
+intersecting patches in a subdirectory of the map patches directory: nodata
+masks, origins relative to the sub-raster they cover, and metadata for that
+sub-raster. predict_unet_map.py predicts it through PatchSubset, without
+copying the patches, and assemble_unet_map.py assembles it like any other
+patch set. mosaic_roi() then writes it into the full map.
+
+Edge pixels of the sub-raster may be covered by patches outside the ROI, so
+would blend differently from a full run. roi_mask.npy marks the pixels whose
+every covering patch was predicted; only those are mosaicked, and they match
+a full run exactly.
+Called from R via reticulate.
+"""
+
+import os
+import json
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from assemble_unet_map import read_origins
+from tile_unet_map import write_origins
+
+
+class PatchSubset:
+    """Array-like view of patches idx of a patch array (or MapPatchReader)"""
+
+    def __init__(self, patches, idx):
+        self.patches = patches
+        self.idx = np.asarray(idx, dtype=np.int64)
+        self.shape = (len(self.idx),) + tuple(patches.shape[1:])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.patches[int(self.idx[i])]
+        if isinstance(i, slice):
+            i = range(*i.indices(len(self)))
+        return self.patches[[int(self.idx[j]) for j in i]]
+
+    def close(self):
+        if hasattr(self.patches, 'close'):
+            self.patches.close()
+
+
+def pixel_window(meta, xmin, ymin, xmax, ymax):
+    """Raster rows and columns [r0, r1) x [c0, c1) touched by a box in map coordinates"""
+    xres = (meta['rast_xmax'] - meta['rast_xmin']) / meta['n_cols_rast']
+    yres = (meta['rast_ymax'] - meta['rast_ymin']) / meta['n_rows_rast']
+    c0 = max(int(np.floor((xmin - meta['rast_xmin']) / xres)), 0)
+    c1 = min(int(np.ceil((xmax - meta['rast_xmin']) / xres)), int(meta['n_cols_rast']))
+    r0 = max(int(np.floor((meta['rast_ymax'] - ymax) / yres)), 0)
+    r1 = min(int(np.ceil((meta['rast_ymax'] - ymin) / yres)), int(meta['n_rows_rast']))
+    return r0, r1, c0, c1
+
+
+def polygon_mask(meta, vertices, r0, r1, c0, c1):
+    """Pixels of window [r0, r1) x [c0, c1) whose centers fall inside a polygon (even-odd rule)"""
+    xres = (meta['rast_xmax'] - meta['rast_xmin']) / meta['n_cols_rast']
+    yres = (meta['rast_ymax'] - meta['rast_ymin']) / meta['n_rows_rast']
+    x = meta['rast_xmin'] + (np.arange(c0, c1) + 0.5) * xres
+    y = meta['rast_ymax'] - (np.arange(r0, r1) + 0.5) * yres
+    px, py = np.meshgrid(x, y)
+    inside = np.zeros(px.shape, dtype=bool)
+    v = np.asarray(vertices, dtype=np.float64)
+    for (xa, ya), (xb, yb) in zip(v, np.roll(v, -1, axis=0)):
+        crosses = (ya > py) != (yb > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xi = xa + (py - ya) * (xb - xa) / (yb - ya)
+        inside ^= crosses & (px < xi)
+    return inside
+
+
+def roi_patches(roi, meta, row0, col0):
+    """
+    Indices of the patches intersecting an ROI.
+
+    Args:
+        roi: Dict with one of 'bbox' ([xmin, ymin, xmax, ymax] in map
+            coordinates), 'polygon' (list of [x, y] vertices in map
+            coordinates), or 'patches' (0-indexed patch indices)
+        meta: Map metadata (map_metadata.json)
+        row0, col0: Patch origins
+
+    Returns:
+        Sorted unique patch indices
+    """
+    ps = int(meta['patch_size'])
+    if 'patches' in roi:
+        idx = np.unique(np.asarray(roi['patches'], dtype=np.int64).ravel())
+        if idx.size and (idx.min() < 0 or idx.max() >= len(row0)):
+            raise ValueError(f'ROI patch indices must be in 0-{len(row0) - 1}')
+        return idx
+    if 'bbox' in roi:
+        xmin, ymin, xmax, ymax = [float(b) for b in roi['bbox']]
+        r0, r1, c0, c1 = pixel_window(meta, xmin, ymin, xmax, ymax)
+        hit = (row0 < r1) & (row0 + ps > r0) & (col0 < c1) & (col0 + ps > c0)
+        return np.flatnonzero(hit) if r1 > r0 and c1 > c0 else np.array([], dtype=np.int64)
+    if 'polygon' in roi:
+        v = np.asarray(roi['polygon'], dtype=np.float64)
+        r0, r1, c0, c1 = pixel_window(meta, v[:, 0].min(), v[:, 1].min(), v[:, 0].max(), v[:, 1].max())
+        if r1 <= r0 or c1 <= c0:
+            return np.array([], dtype=np.int64)
+        inside = polygon_mask(meta, v, r0, r1, c0, c1)
+        # Summed-area table: any pixel inside the polygon within each patch's window
+        sat = np.zeros((r1 - r0 + 1, c1 - c0 + 1), dtype=np.int64)
+        sat[1:, 1:] = inside.cumsum(axis=0).cumsum(axis=1)
+        a = np.clip(row0 - r0, 0, r1 - r0)
+        b = np.clip(row0 + ps - r0, 0, r1 - r0)
+        c = np.clip(col0 - c0, 0, c1 - c0)
+        d = np.clip(col0 + ps - c0, 0, c1 - c0)
+        n_inside = sat[b, d] - sat[a, d] - sat[b, c] + sat[a, c]
+        return np.flatnonzero(n_inside > 0)
+    raise ValueError("roi must have one of 'bbox', 'polygon', or 'patches'")
+
+
+def prepare_roi(patches_dir, meta, roi):
+    """
+    Write the patch set for an ROI to <patches_dir>/roi_<name>.
+
+    Writes {SITE}_map_nodata.npy, patch_origins.csv and map_metadata.json for
+    the intersecting patches, with origins and extent for the sub-raster they
+    cover, plus roi_mask.npy (1 = pixel identical to a full run). The metadata's
+    roi entry records the ROI, the patch indices in the full set, and the
+    sub-raster's row and column offsets in the full raster.
+
+    Args:
+        patches_dir: Full map patches directory
+        meta: Its map metadata
+        roi: ROI (see roi_patches()); an optional 'name' (default 'roi')
+            names the subdirectory
+
+    Returns:
+        (roi_dir, patch indices)
+    """
+    site = meta['site'].upper()
+    ps = int(meta['patch_size'])
+    n_rows, n_cols = int(meta['n_rows_rast']), int(meta['n_cols_rast'])
+    row0, col0 = read_origins(patches_dir)
+
+    idx = roi_patches(roi, meta, row0, col0)
+    if idx.size == 0:
+        raise ValueError('ROI does not intersect any map patches')
+
+    # Sub-raster covered by the selected patches
+    r_lo, c_lo = int(row0[idx].min()), int(col0[idx].min())
+    r_hi, c_hi = min(int(row0[idx].max()) + ps, n_rows), min(int(col0[idx].max()) + ps, n_cols)
+    h, w = r_hi - r_lo, c_hi - c_lo
+
+    # Pixels covered only by selected patches match a full run
+    covered = np.zeros((h, w), dtype=np.int32)
+    chosen = np.zeros((h, w), dtype=np.int32)
+    selected = np.zeros(len(row0), dtype=bool)
+    selected[idx] = True
+    near = np.flatnonzero((row0 < r_hi) & (row0 + ps > r_lo) & (col0 < c_hi) & (col0 + ps > c_lo))
+    for i in near:
+        a, b = max(int(row0[i]), r_lo) - r_lo, min(int(row0[i]) + ps, r_hi) - r_lo
+        c, d = max(int(col0[i]), c_lo) - c_lo, min(int(col0[i]) + ps, c_hi) - c_lo
+        covered[a:b, c:d] += 1
+        if selected[i]:
+            chosen[a:b, c:d] += 1
+    roi_mask = ((covered == chosen) & (covered > 0)).astype(np.uint8)
+
+    name = str(roi.get('name', 'roi'))
+    roi_dir = os.path.join(patches_dir, f'roi_{name}')
+    os.makedirs(roi_dir, exist_ok=True)
+
+    nodata = np.load(os.path.join(patches_dir, f'{site}_map_nodata.npy'), mmap_mode='r')
+    np.save(os.path.join(roi_dir, f'{site}_map_nodata.npy'), np.asarray(nodata[idx]))
+    np.save(os.path.join(roi_dir, 'roi_mask.npy'), roi_mask)
+    write_origins(os.path.join(roi_dir, 'patch_origins.csv'), row0[idx] - r_lo, col0[idx] - c_lo)
+
+    xres = (meta['rast_xmax'] - meta['rast_xmin']) / n_cols
+    yres = (meta['rast_ymax'] - meta['rast_ymin']) / n_rows
+    sub = dict(meta)
+    sub.pop('stack_file', None)                                 # patches come from the parent set
+    sub.update({
+        'n_patches': int(idx.size),
+        'n_rows_rast': h,
+        'n_cols_rast': w,
+        'rast_xmin': meta['rast_xmin'] + c_lo * xres,
+        'rast_xmax': meta['rast_xmin'] + c_hi * xres,
+        'rast_ymax': meta['rast_ymax'] - r_lo * yres,
+        'rast_ymin': meta['rast_ymax'] - r_hi * yres,
+        'roi': {
+            'spec': dict(roi),
+            'patch_index': idx.tolist(),
+            'row_offset': r_lo,
+            'col_offset': c_lo,
+            'parent_dir': os.path.abspath(patches_dir),
+        },
+    })
+    with open(os.path.join(roi_dir, 'map_metadata.json'), 'w') as f:
+        json.dump(sub, f, indent=2)
+
+    print(f'ROI {name}: {idx.size} / {len(row0)} patches, {w} x {h} sub-raster at row {r_lo}, col {c_lo} '
+          f'({int(roi_mask.sum())} pixels exact)')
+    return roi_dir, idx
+
+
+def mosaic_roi(roi_dir, roi_file, map_file):
+    """
+    Write an assembled ROI raster into the full map, in place.
+
+    Only pixels in roi_mask.npy (those covered solely by ROI patches) are
+    replaced. Internal overviews of map_file are rebuilt.
+
+    Args:
+        roi_dir: ROI patch set directory (from prepare_roi())
+        roi_file: GeoTIFF assembled from roi_dir (any number of bands)
+        map_file: Full map GeoTIFF with the same bands, updated in place
+
+    Returns:
+        Number of pixels replaced
+    """
+    with open(os.path.join(roi_dir, 'map_metadata.json'), 'r') as f:
+        meta = json.load(f)
+    mask = np.load(os.path.join(roi_dir, 'roi_mask.npy')).astype(bool)
+    window = Window(meta['roi']['col_offset'], meta['roi']['row_offset'],
+                    meta['n_cols_rast'], meta['n_rows_rast'])
+
+    with rasterio.open(roi_file) as src, rasterio.open(map_file, 'r+') as dst:
+        if src.count != dst.count:
+            raise ValueError(f'{roi_file} has {src.count} bands; {map_file} has {dst.count}')
+        new = src.read()
+        old = dst.read(window=window)
+        old[:, mask] = new[:, mask]
+        dst.write(old, window=window)
+        factors = dst.overviews(1)
+        if factors:
+            dst.build_overviews(factors, Resampling.nearest if dst.dtypes[0] == 'uint8' else Resampling.average)
+    return int(mask.sum())
@@ -0,0 +1,208 @@
+"""
+Tile a map input stack into overlapping U-Net patches, streaming from GeoTIFF
+
+Python counterpart of the patch extraction in do_unet_prep_map.R. The
+normalized input stack is read from GeoTIFF one stripe of patch rows at a
+time, so only patch_size rows of the raster are in memory at once. Origins,
+the nodata mask (a pixel is nodata if any channel is NA) and zero edge
+padding are identical to the R version, and are computed with vectorized
+NumPy. Patches are either written incrementally to a memory-mapped
+`{SITE}_map_patches.npy`, or not written at all: MapPatchReader serves them
+straight from the stack to predict_unet_map.py.
+Called from R via reticulate.
+"""
+
+import os
+import csv
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from numpy.lib.format import open_memmap
+
+from assemble_unet_map import read_origins
+
+
+def patch_origins(n_rows, n_cols, patch_size, stride):
+    """
+    Patch origins covering the raster, as in do_unet_prep_map.R.
+
+    Args:
+        n_rows, n_cols: Raster size in pixels
+        patch_size: Patch size in pixels
+        stride: Step between patches in pixels (may be fractional)
+
+    Returns:
+        row0, col0: 0-indexed top-left pixel of each patch, columns varying
+        fastest (the order of expand.grid(col, row))
+    """
+    def axis(n):
+        o = [x for x in np.arange(0, n, stride) if x <= n - 1]            # seq(0, n - 1, by = stride)
+        if o[-1] + patch_size < n:                              # final patch flush with the edge
+            o.append(n - patch_size)
+        return np.unique(np.maximum(np.floor(o), 0)).astype(np.int64)
+
+    rows, cols = axis(n_rows), axis(n_cols)
+    return np.repeat(rows, len(cols)), np.tile(cols, len(rows))
+
+
+def write_origins(path, row0, col0):
+    """Write patch_origins.csv in the layout R's write.csv() produces"""
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        w.writerow(['col', 'row'])
+        w.writerows(zip(col0.tolist(), row0.tolist()))
+
+
+class MapStack:
+    """Windowed reader for the normalized input stack GeoTIFF"""
+
+    def __init__(self, stack_file):
+        self.src = rasterio.open(stack_file)
+        self.n_rows = self.src.height
+        self.n_cols = self.src.width
+        self.n_channels = self.src.count
+
+    def read_rows(self, r0, h):
+        """
+        Read h rows from r0, zero-padded past the bottom edge.
+
+        Returns:
+            values: (h, n_cols, C) float32 with nodata set to 0
+            valid: (h, n_cols) uint8, 1 = all channels valid, 0 = nodata or padding
+        """
+        values = np.zeros((h, self.n_cols, self.n_channels), dtype=np.float32)
+        valid = np.zeros((h, self.n_cols), dtype=np.uint8)
+        n = min(h, self.n_rows - r0)
+        if n > 0:
+            window = Window(0, r0, self.n_cols, n)
+            data = self.src.read(window=window, out_dtype=np.float32)        # (C, n, n_cols)
+            na = ~np.isfinite(data) | (self.src.read_masks(window=window) == 0)
+            data[na] = 0                                                    # replace NA with 0 for model
+            values[:n] = data.transpose(1, 2, 0)
+            valid[:n] = ~na.any(axis=0)                                     # nodata if ANY channel is NA
+        return values, valid
+
+    def close(self):
+        self.src.close()
+
+
+def cut_patches(values, valid, col0, patch_size):
+    """
+    Cut patches along one stripe of patch_size rows.
+
+    Args:
+        values: (patch_size, n_cols, C) stripe from MapStack.read_rows
+        valid: (patch_size, n_cols) validity mask for the stripe
+        col0: Column origins of the patches in this stripe
+        patch_size: Patch size in pixels
+
+    Returns:
+        patches: (n, patch_size, patch_size, C) float32
+        nodata: (n, patch_size, patch_size) uint8, 1 = valid, 0 = nodata or padding
+    """
+    pad = max(0, int(col0.max()) + patch_size - values.shape[1])            # columns past the right edge
+    if pad:
+        values = np.pad(values, ((0, 0), (0, pad), (0, 0)))
+        valid = np.pad(valid, ((0, 0), (0, pad)))
+    cols = col0[:, None] + np.arange(patch_size)                            # (n, patch_size)
+    patches = values[:, cols].transpose(1, 0, 2, 3)                         # (n, H, W, C)
+    nodata = valid[:, cols].transpose(1, 0, 2)                              # (n, H, W)
+    return patches, nodata
+
+
+def tile_unet_map(stack_file, output_dir, site, patch_size, stride, write_patches=True):
+    """
+    Tile the input stack into patches, nodata masks and origins for mapping.
+
+    Args:
+        stack_file: Normalized input stack GeoTIFF (from unet_build_input_stack)
+        output_dir: Map patches directory
+        site: Site code (for file names)
+        patch_size: Patch size in pixels
+        stride: Step between patches in pixels
+        write_patches: If True, write `{SITE}_map_patches.npy` (memory-mapped, a
+            stripe at a time). If False, skip it; predict_unet_map.py then reads
+            patches from stack_file with MapPatchReader
+
+    Returns:
+        Dict with n_patches, n_rows, n_cols, n_channels
+    """
+
+    site = site.upper()
+    patch_size = int(patch_size)
+    stack = MapStack(stack_file)
+    row0, col0 = patch_origins(stack.n_rows, stack.n_cols, patch_size, stride)
+    n_patches = len(row0)
+
+    print(f'Tiling {stack.n_cols} x {stack.n_rows} raster into {n_patches} patches '
+          f'({patch_size}x{patch_size}, stride {stride})')
+
+    os.makedirs(output_dir, exist_ok=True)
+    nodata = open_memmap(os.path.join(output_dir, f'{site}_map_nodata.npy'), mode='w+',
+                         dtype=np.uint8, shape=(n_patches, patch_size, patch_size))
+    patches = None
+    if write_patches:
+        patches = open_memmap(os.path.join(output_dir, f'{site}_map_patches.npy'), mode='w+',
+                              dtype=np.float32, shape=(n_patches, patch_size, patch_size, stack.n_channels))
+
+    try:
+        starts = np.flatnonzero(np.r_[True, row0[1:] != row0[:-1]])          # first patch of each stripe
+        ends = np.r_[starts[1:], n_patches]
+        for s, e in zip(starts, ends):
+            values, valid = stack.read_rows(int(row0[s]), patch_size)
+            p, nd = cut_patches(values, valid, col0[s:e], patch_size)
+            nodata[s:e] = nd
+            if patches is not None:
+                patches[s:e] = p
+            print(f'  Rows {min(int(row0[s]) + patch_size, stack.n_rows)} / {stack.n_rows} ({e} patches)')
+    finally:
+        stack.close()
+
+    nodata.flush()
+    del nodata
+    if patches is not None:
+        patches.flush()
+        del patches
+
+    write_origins(os.path.join(output_dir, 'patch_origins.csv'), row0, col0)
+
+    return {'n_patches': n_patches, 'n_rows': stack.n_rows, 'n_cols': stack.n_cols,
+            'n_channels': stack.n_channels}
+
+
+class MapPatchReader:
+    """
+    Array-like view of the map patches, cut on demand from the input stack.
+
+    Stands in for the `{SITE}_map_patches.npy` array in predict_unet_map.py when
+    patches weren't written: supports len(), .shape, and indexing by an int, a
+    slice, or a list of patch indices. The most recent stripe is kept, so
+    reading patches in order touches each raster row about once per stripe.
+    """
+
+    def __init__(self, patches_dir, stack_file, patch_size):
+        self.stack = MapStack(stack_file)
+        self.patch_size = int(patch_size)
+        self.row0, self.col0 = read_origins(patches_dir)
+        self.shape = (len(self.row0), self.patch_size, self.patch_size, self.stack.n_channels)
+        self._stripe = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _patch(self, i):
+        r0 = int(self.row0[i])
+        if self._stripe[0] != r0:
+            self._stripe = (r0, self.stack.read_rows(r0, self.patch_size)[0])
+        return cut_patches(self._stripe[1], np.ones(self._stripe[1].shape[:2], dtype=np.uint8),
+                           self.col0[i:i + 1], self.patch_size)[0][0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self._patch(int(idx))
+        if isinstance(idx, slice):
+            idx = range(*idx.indices(len(self)))
+        return np.stack([self._patch(int(i)) for i in idx])
+
+    def close(self):
+        self.stack.close()
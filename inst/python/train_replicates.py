@@ -0,0 +1,369 @@
+"""
+Train several seed replicates of a U-Net as one batched model
+
+The pixel-degradation experiment trains many seed replicates of the same
+small U-Net on the same patches. Run one at a time, each leaves a large GPU
+mostly idle at batch_size=8. train_unet_replicates() trains M independently
+initialized replicates in one process: their parameters and BatchNorm
+buffers are stacked (torch.func.stack_module_state) and the model is run
+with torch.func.vmap over the replicate dimension, so each step is one
+batched forward and backward pass on an [M, B, C, H, W] input.
+
+Each replicate keeps what would distinguish it as a separate run:
+- initial weights drawn after torch.manual_seed(seed), as in train_unet()
+- its own shuffle order (a torch.Generator seeded with seed) and
+  augmentation stream (random.Random(seed))
+- its own loss, gradient clipping norm, and skipped batches
+Adam and weight decay are elementwise, so one optimizer over the stacked
+parameters is M independent optimizers.
+
+Each replicate's output directory gets the same files as a train_unet() run:
+unet_<SITE>_final.pth, class_weights.json, progress.txt,
+training_metrics.csv, and the model config one level up. Results are not
+bit-identical to separate runs: augmentation streams aren't interleaved with
+validation draws, and a replicate that skips a batch still shares Adam's step
+count (bias correction) with the others.
+
+Supports the core train_unet() options; memory budgeting, frozen encoders and
+async evaluation are for single runs.
+"""
+
+import copy
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state
+from torch.utils.data import DataLoader
+
+from unet_models import build_unet, init_unet_from
+from ordinal import corn_loss_masked
+from carving import carve_train_split
+from train_unet import (MaskedPatchDataset, MaskedCrossEntropyLoss, validate, load_split,
+                        class_weight_vector, new_history, add_eval_results, best_ccrs, save_fit,
+                        write_training_metrics, warmup_lr)
+
+
+class ReplicateStack:
+    """
+    M U-Nets of the same architecture with stacked parameters and buffers,
+    called as one vmapped model.
+
+    Args:
+        models: List of M models on the training device
+    """
+
+    def __init__(self, models):
+        self.n = len(models)
+        self.keys = list(models[0].state_dict().keys())
+        self.params, self.buffers = stack_module_state(models)  # [M, ...] leaves
+        self.base = copy.deepcopy(models[0]).to('meta')          # architecture only
+        self.base.train()
+
+        def call(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+        self._forward = torch.vmap(call, in_dims=(0, 0, 0), randomness='different')
+
+    def __call__(self, x):
+        """[M, B, C, H, W] input -> [M, B, K, H, W] outputs"""
+        return self._forward(self.params, self.buffers, x)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def state_dict(self, m):
+        """State dict of replicate m, on the CPU, in the usual key order"""
+        stacked = {**self.params, **self.buffers}
+        return {k: stacked[k][m].detach().cpu().clone() for k in self.keys}
+
+
+def _clip_per_replicate(params, max_norm):
+    """clip_grad_norm_ applied to each replicate's slice of the stacked gradients"""
+    grads = [p.grad for p in params if p.grad is not None]
+    norms = torch.sqrt(sum(g.flatten(1).pow(2).sum(1) for g in grads))          # [M]
+    coef = torch.clamp(max_norm / (norms + 1e-6), max=1.0)
+    for g in grads:
+        g.mul_(coef.view((-1,) + (1,) * (g.dim() - 1)))
+    return norms
+
+
+def _train_step(stack, batches, criterion, optimizer, device, config):
+    """
+    One optimizer step for all replicates.
+
+    Args:
+        batches: List of M (patches, labels, masks) batches, one per replicate
+
+    Returns:
+        List of M losses, None for replicates whose batch was skipped
+    """
+    use_ordinal = config['use_ordinal']
+    ignore_index = config['ignore_index']
+
+    # Batches train_one_epoch() would skip before the forward pass
+    empty = []
+    for patches, labels, masks in batches:
+        valid = (masks != 0) & (labels != ignore_index)
+        empty.append(bool(masks.sum() == 0 or torch.isnan(patches).any()
+                          or torch.isnan(labels.float()).any() or valid.sum() == 0))
+    if all(empty):
+        return [None] * stack.n
+    empty_idx = [m for m in range(stack.n) if empty[m]]
+    saved_buffers = {k: v[empty_idx].clone() for k, v in stack.buffers.items()} if empty_idx else None
+
+    patches = torch.stack([b[0] for b in batches]).to(device)
+    labels = torch.stack([b[1] for b in batches]).to(device)
+    masks = torch.stack([b[2] for b in batches]).to(device)
+
+    optimizer.zero_grad()
+    outputs = stack(patches)
+
+    losses = [None] * stack.n
+    total = 0.0
+    for m in range(stack.n):
+        if empty[m]:
+            continue
+        if torch.isnan(outputs[m]).any() or torch.isinf(outputs[m]).any():
+            print(f"  WARNING: NaN/Inf outputs for replicate {m}")
+            continue
+        if use_ordinal:
+            valid = (masks[m] != 0) & (labels[m] != ignore_index)
+            loss = corn_loss_masked(outputs[m], labels[m], valid)
+        else:
+            loss = criterion(outputs[m], labels[m], masks[m])
+        if torch.isnan(loss) or torch.isinf(loss):
+            print(f"  WARNING: NaN/Inf loss for replicate {m}")
+            continue
+        losses[m] = loss
+        total = total + loss
+
+    if any(l is not None for l in losses):
+        total.backward()
+
+    if saved_buffers is not None:                               # skipped batches don't update BatchNorm stats
+        with torch.no_grad():
+            for k, v in stack.buffers.items():
+                v[empty_idx] = saved_buffers[k]
+
+    skipped = [m for m in range(stack.n) if losses[m] is None]
+    if len(skipped) == stack.n:
+        return losses
+
+    params = stack.parameters()
+    _clip_per_replicate(params, config['gradient_clip_max_norm'])
+
+    # Replicates with a skipped batch keep their weights and Adam moments
+    saved = []
+    if skipped:
+        for p in params:
+            state = optimizer.state.get(p, {})
+            saved.append((p, p.detach()[skipped].clone(),
+                          {k: state[k][skipped].clone() if k in state else None
+                           for k in ('exp_avg', 'exp_avg_sq')}))
+    optimizer.step()
+    with torch.no_grad():
+        for p, weights, moments in saved:
+            p[skipped] = weights
+            for k, v in moments.items():
+                optimizer.state[p][k][skipped] = 0 if v is None else v
+
+    return [None if l is None else l.item() for l in losses]
+
+
+def train_unet_replicates(site, data_dir, output_dirs, seeds, original_classes=None,
+    encoder_name="resnet18", encoder_weights=None, learning_rate=0.0001,
+    weight_decay=1e-4, class_weighting='freq', n_epochs=50, batch_size=8,
+    gradient_clip_max_norm=1.0, num_classes=4, in_channels=None,
+    use_ordinal=False, test_interval=5, requirecuda=True, class_weights=None,
+    carve_radius=None, carve_plots=None, init_from=None, init_scope='all', warmup_epochs=0):
+    """
+    Train seed replicates of a U-Net on the same data as one batched model
+
+    Args:
+        site: Site's 3-letter code (e.g., "nor")
+        data_dir: Directory containing numpy files
+        output_dirs: One output directory per replicate (as train_unet's output_dir)
+        seeds: One random seed per replicate
+        init_from: Optional .pth to warm-start every replicate from, or a
+            list of one per replicate (None entries start from scratch)
+        Remaining arguments: as for train_unet()
+
+    Returns:
+        List of {'model_path', 'ccr'}, one per replicate
+    """
+
+    seeds = [int(s) for s in np.atleast_1d(seeds)]
+    output_dirs = [output_dirs] if isinstance(output_dirs, str) else list(output_dirs)
+    if len(seeds) != len(output_dirs):
+        raise ValueError(f"{len(seeds)} seeds but {len(output_dirs)} output_dirs")
+    n_rep = len(seeds)
+
+    if in_channels is None:
+        with open(os.path.join(data_dir, f"{site}_metadata.json")) as f:
+            in_channels = json.load(f)['in_channels']
+    original_classes = [int(x) for x in original_classes] if original_classes is not None \
+        else list(range(num_classes))
+
+    print("=" * 60)
+    print(f"Training {n_rep} U-Net replicates for {site} (seeds {seeds})")
+    print("=" * 60)
+
+    cuda_available = torch.cuda.is_available()
+    if requirecuda and not cuda_available:
+        raise RuntimeError("CUDA is not available but requirecuda=True. "
+                           "Check GPU allocation and driver/module setup.")
+    device = torch.device('cuda' if cuda_available else 'cpu')
+    print(f"Using device: {device}")
+
+    # Data, shared by all replicates
+    train_patches, train_labels, train_masks = load_split(data_dir, site, 'train')
+    carve_log = None
+    if carve_radius is not None or carve_plots is not None:
+        train_patches, train_labels, train_masks, carve_log = carve_train_split(
+            data_dir, site, train_patches, train_labels, train_masks, carve_radius, carve_plots)
+    validate_patches, validate_labels, validate_masks = load_split(data_dir, site, 'validate')
+    test_patches, test_labels, test_masks = load_split(data_dir, site, 'test')
+
+    actual_classes = len(np.unique(train_labels[train_labels != 255]))
+    assert actual_classes == num_classes, f"Found {actual_classes} classes but expected {num_classes}"
+
+    class_pixel_counts = np.array([float(((train_labels == c) & (train_masks == 1)).sum())
+                                   for c in range(num_classes)])
+    class_weights, class_weighting = class_weight_vector(class_pixel_counts, num_classes,
+                                                         class_weighting, class_weights)
+    criterion = None if use_ordinal else \
+        MaskedCrossEntropyLoss(weight=torch.FloatTensor(class_weights).to(device), ignore_index=255)
+
+    # Per-replicate data order and augmentation
+    # (shallow copies of one dataset share its tensors)
+    train_dataset = MaskedPatchDataset(train_patches, train_labels, train_masks)
+    validate_dataset = MaskedPatchDataset(validate_patches, validate_labels, validate_masks)
+    train_loaders, validate_loaders = [], []
+    for seed in seeds:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        dataset = copy.copy(train_dataset)
+        dataset.rng = random.Random(seed)
+        train_loaders.append(DataLoader(dataset, batch_size=batch_size, shuffle=True, generator=generator))
+        dataset = copy.copy(validate_dataset)
+        dataset.rng = random.Random(seed + 1)
+        validate_loaders.append(DataLoader(dataset, batch_size=batch_size, shuffle=False))
+    test_loader = DataLoader(MaskedPatchDataset(test_patches, test_labels, test_masks, augment=False),
+                             batch_size=batch_size, shuffle=False)
+    has_val = len(validate_loaders[0]) > 0
+    has_test = len(test_loader) > 0
+
+    # Models: each initialized from its own seed, as train_unet() would
+    if init_from is None or isinstance(init_from, str):
+        init_from = [init_from] * n_rep
+    if len(init_from) != n_rep:
+        raise ValueError(f"{len(init_from)} init_from paths for {n_rep} replicates")
+    models, init_logs = [], []
+    for seed, init_path in zip(seeds, init_from):
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed_all(seed)
+        model = build_unet(encoder_name, in_channels, num_classes,
+                           use_ordinal=use_ordinal, encoder_weights=encoder_weights)
+        init_logs.append(init_unet_from(model, init_path, init_scope) if init_path is not None else None)
+        models.append(model.to(device))
+    stack = ReplicateStack(models)
+    eval_model = models[0]                                      # reloaded with each replicate's weights
+    del models[1:]
+
+    optimizer = torch.optim.Adam(stack.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    training_config = {
+        'use_ordinal': use_ordinal,
+        'num_classes': num_classes,
+        'ignore_index': 255,
+        'gradient_clip_max_norm': gradient_clip_max_norm,
+    }
+
+    # class_weights.json, as written by train_unet()
+    for seed, output_dir, init_log in zip(seeds, output_dirs, init_logs):
+        os.makedirs(output_dir, exist_ok=True)
+        run_log = {
+            "seed": seed,
+            "class_weighting": class_weighting,
+            "original_classes": original_classes,
+            "class_pixel_counts": [float(x) for x in class_pixel_counts],
+            "class_weights": [float(x) for x in class_weights],
+            "batch_size": batch_size,
+            "micro_batch_size": batch_size,
+            "accumulation_steps": 1,
+            "memory_budget_gb": None,
+            "probe_peak_gb": None,
+            "activation_checkpointing": False,
+            "freeze_encoder": False,
+            "async_eval": False,
+            "init": init_log,
+            "warmup_epochs": int(warmup_epochs),
+        }
+        if carve_log is not None:
+            run_log["carve"] = carve_log
+        with open(os.path.join(output_dir, "class_weights.json"), "w") as f:
+            json.dump(run_log, f, indent=2)
+
+    histories = [new_history(num_classes) for _ in seeds]
+    progress_files = [open(os.path.join(d, 'progress.txt'), 'w') for d in output_dirs]
+
+    for epoch in range(n_epochs):
+        if warmup_epochs:
+            warmup_lr(optimizer, learning_rate, epoch, warmup_epochs)
+        running = np.zeros(n_rep)
+        counted = np.zeros(n_rep)
+        n_batches = len(train_loaders[0])
+        for batches in zip(*train_loaders):
+            losses = _train_step(stack, batches, criterion, optimizer, device, training_config)
+            for m, loss in enumerate(losses):
+                if loss is not None:
+                    running[m] += loss
+                    counted[m] += 1
+
+        run_test = has_test and ((epoch + 1) % test_interval == 0 or epoch == n_epochs - 1)
+        for m in range(n_rep):
+            train_loss = running[m] / counted[m] if counted[m] > 0 else float('nan')
+            if counted[m] < n_batches:
+                print(f"  → replicate {m}: {n_batches - int(counted[m])} batches skipped")
+            histories[m]['train_loss'].append(train_loss)
+
+            eval_model.load_state_dict(stack.state_dict(m))
+            results = {}
+            if has_val:
+                results['validate'] = validate(eval_model, validate_loaders[m], criterion, device, training_config)
+            if run_test:
+                results['test'] = validate(eval_model, test_loader, criterion, device, training_config)
+            add_eval_results(histories[m], epoch, results, num_classes)
+
+            line = f"Epoch {epoch+1}/{n_epochs} | train loss: {train_loss:.4f}"
+            if has_val:
+                line += f" | val CCR: {results['validate'][1]:.2%}"
+            if run_test:
+                line += f" | test CCR: {results['test'][1]:.2%}"
+            print(f"[seed {seeds[m]}] {line}", flush=True)
+            progress_files[m].write(line + '\n')
+            progress_files[m].flush()
+
+    for f in progress_files:
+        f.close()
+
+    config = {
+        'encoder_name': encoder_name,
+        'encoder_weights': encoder_weights,
+        'in_channels': in_channels,
+        'num_classes': num_classes,
+        'original_classes': original_classes,
+        'site': site,
+        'use_ordinal': use_ordinal
+    }
+    out = []
+    for m, (seed, output_dir) in enumerate(zip(seeds, output_dirs)):
+        model_path = save_fit(stack.state_dict(m), output_dir, site, config)
+        write_training_metrics(os.path.join(output_dir, 'training_metrics.csv'), histories[m],
+                               n_epochs, original_classes)
+        best_val_ccr, _, best_test_ccr, _ = best_ccrs(histories[m])
+        out.append({'model_path': model_path, 'ccr': best_test_ccr or best_val_ccr or 0.0})
+        print(f"[seed {seed}] Model saved to: {model_path}")
+
+    return out
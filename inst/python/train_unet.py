@@ -15,21 +15,19 @@ import random
 import os
 from pathlib import Path
 
+from unet_models import build_unet, init_unet_from
+from ordinal import corn_loss_masked, corn_label
+from training_memory import enable_checkpointing, device_budget_bytes, probe_micro_batch, loss_share
+from feature_cache import FeatureCache, DIHEDRAL
+from async_eval import AsyncEvaluator, choose_eval_device
+from carving import carve_train_split
+from multisite import read_sources, open_split, split_class_counts, MultiSiteDataset, site_sampler, site_metrics
+
 # Force line-buffered stdout so epoch progress appears in real time
 # (important when called via reticulate or batch jobs)
 if hasattr(sys.stdout, 'reconfigure'):
     sys.stdout.reconfigure(line_buffering=True)
 
-# Try to import CORAL for ordinal regression
-try:
-    from coral_pytorch.dataset import corn_label_from_logits
-    from coral_pytorch.losses import corn_loss
-    CORAL_AVAILABLE = True
-except ImportError:
-    CORAL_AVAILABLE = False
-    print("NOTE: coral_pytorch not available. Install with: pip install coral-pytorch")
-    print("      Ordinal regression will not be available.")
-
 print(f"PyTorch version: {torch.__version__}")
 
 
@@ -47,12 +45,16 @@ class MaskedPatchDataset(Dataset):
     - Augmentation (rotations and flips)
     """
     
-    def __init__(self, patches, labels, masks, augment=True):
+    def __init__(self, patches, labels, masks, augment=True, return_index=False, rng=None):
         """
         Args:
             patches: numpy array [N, H, W, C] - N patches, H×W size, C channels
             labels: numpy array [N, H, W] - class labels (0-n or 255)
             masks: numpy array [N, H, W] - binary masks (1=labeled, 0=unlabeled)
+            return_index: also return the patch index and dihedral transform id
+                (0-7) of the augmentation, for the encoder feature cache
+            rng: random.Random for augmentation draws (default: the global
+                random module)
         """
         self.patches = torch.from_numpy(patches).float()
         self.labels = torch.from_numpy(labels).long()
@@ -61,6 +63,8 @@ class MaskedPatchDataset(Dataset):
         # PyTorch expects [N, C, H, W] not [N, H, W, C]
         self.patches = self.patches.permute(0, 3, 1, 2)
         self.augment = augment
+        self.return_index = return_index
+        self.rng = rng if rng is not None else random
         
         print(f"Dataset created:")
         print(f"  Patches shape: {self.patches.shape}")
@@ -70,32 +74,39 @@ class MaskedPatchDataset(Dataset):
     def __len__(self):
         return len(self.patches)
     
+    def _get(self, idx):
+        """Unaugmented patch, label, and mask (overridden by multisite.MultiSiteDataset)"""
+        return self.patches[idx], self.labels[idx], self.masks[idx]
+    
     def __getitem__(self, idx):
         """Return one patch, label, and mask, randomly rotated and flipped"""
-        patch = self.patches[idx]
-        label = self.labels[idx]
-        mask = self.masks[idx]
+        patch, label, mask = self._get(idx)
+        k = hflip = vflip = 0
         
         if self.augment:
             # Random rotation (0, 90, 180, 270)
-            if random.random() > 0.5:
-                k = random.randint(0, 3)
+            if self.rng.random() > 0.5:
+                k = self.rng.randint(0, 3)
                 patch = torch.rot90(patch, k, dims=[1, 2])
                 label = torch.rot90(label.unsqueeze(0), k, dims=[1, 2]).squeeze(0)
                 mask = torch.rot90(mask.unsqueeze(0), k, dims=[1, 2]).squeeze(0)
             
             # Random horizontal flip
-            if random.random() > 0.5:
+            if self.rng.random() > 0.5:
+                hflip = 1
                 patch = torch.flip(patch, dims=[2])
                 label = torch.flip(label, dims=[1])
                 mask = torch.flip(mask, dims=[1])
             
             # Random vertical flip
-            if random.random() > 0.5:
+            if self.rng.random() > 0.5:
+                vflip = 1
                 patch = torch.flip(patch, dims=[1])
                 label = torch.flip(label, dims=[0])
                 mask = torch.flip(mask, dims=[0])
         
+        if self.return_index:
+            return patch, label, mask, idx, DIHEDRAL[(k, hflip, vflip)]
         return patch, label, mask
 
 
@@ -135,9 +146,16 @@ def train_one_epoch(model, dataloader, criterion, optimizer, device, config):
     Train for one epoch
     
     Args:
-        config: dict with 'use_ordinal', 'num_classes', 'ignore_index', 'gradient_clip_max_norm'
+        config: dict with 'use_ordinal', 'num_classes', 'ignore_index', 'gradient_clip_max_norm',
+            and optionally 'micro_batch_size', 'class_weights', 'freeze_encoder' and
+            'feature_cache'. With a micro-batch
+            size smaller than the batch, each batch is run in micro-batches and
+            gradients are accumulated, with each micro-batch's loss weighted by its
+            share of the batch's loss denominator so the step matches the whole batch.
     """
     model.train()
+    if config.get('freeze_encoder'):
+        model.encoder.eval()                                    # frozen BatchNorm statistics
     running_loss = 0.0
     nan_count = 0
     
@@ -145,12 +163,12 @@ def train_one_epoch(model, dataloader, criterion, optimizer, device, config):
     num_classes = config['num_classes']
     ignore_index = config['ignore_index']
     max_norm = config['gradient_clip_max_norm']
+    micro_batch_size = config.get('micro_batch_size')
+    class_weights = config.get('class_weights')
+    feature_cache = config.get('feature_cache')
     
-    for batch_idx, (patches, labels, masks) in enumerate(dataloader):
-        patches = patches.to(device)
-        labels = labels.to(device)
-        masks = masks.to(device)
-        
+    for batch_idx, batch in enumerate(dataloader):
+        patches, labels, masks = batch[:3]
         # Skip batches with no labeled pixels
         if masks.sum() == 0:
             nan_count += 1
@@ -162,56 +180,69 @@ def train_one_epoch(model, dataloader, criterion, optimizer, device, config):
             nan_count += 1
             continue
         
-        optimizer.zero_grad()
-        outputs = model(patches)
-        
-        # Check outputs
-        if torch.isnan(outputs).any() or torch.isinf(outputs).any():
-            print(f"  WARNING: NaN/Inf in outputs at batch {batch_idx}")
+        valid_mask = (masks != 0) & (labels != ignore_index)
+        if valid_mask.sum() == 0:
             nan_count += 1
             continue
         
-        # Compute loss based on mode
-        if use_ordinal:
-            # CORAL ordinal loss
-            labels_masked = labels.clone()
-            labels_masked[masks == 0] = ignore_index
-            
-            valid_mask = labels_masked != ignore_index
-            
-            if valid_mask.sum() == 0:
-                nan_count += 1
+        # Micro-batches (a single one when the whole batch fits)
+        n = patches.shape[0]
+        step = micro_batch_size or n
+        parts = [slice(i, min(i + step, n)) for i in range(0, n, step)]
+        if len(parts) > 1:
+            shares = [loss_share(labels[p], valid_mask[p], num_classes, use_ordinal, class_weights)
+                      for p in parts]
+            shares = [x / sum(shares) for x in shares]
+        else:
+            shares = [1.0]
+        
+        optimizer.zero_grad()
+        batch_loss = 0.0
+        problem = None
+        for part, share in zip(parts, shares):
+            if share == 0:                                      # no labeled pixels in this micro-batch
                 continue
+            part_patches = patches[part].to(device)
+            part_labels = labels[part].to(device)
+            part_masks = masks[part].to(device)
             
-            # Flatten spatial dimensions for CORAL
-            # outputs: [B, num_classes-1, H, W] -> [B*H*W, num_classes-1]
-            B, C, H, W = outputs.shape
-            outputs_flat = outputs.permute(0, 2, 3, 1).reshape(-1, C)
-            labels_flat = labels_masked.reshape(-1)
-            valid_mask_flat = valid_mask.reshape(-1)
+            if feature_cache is not None:                       # cached encoder features for this augmentation
+                feature_cache.prepare(part_patches, batch[3][part], batch[4][part])
+            outputs = model(part_patches)
             
-            # Filter to valid pixels only
-            outputs_valid = outputs_flat[valid_mask_flat]
-            labels_valid = labels_flat[valid_mask_flat]
+            # Check outputs
+            if torch.isnan(outputs).any() or torch.isinf(outputs).any():
+                problem = "outputs"
+                break
             
-            # Compute CORAL loss
-            loss = corn_loss(outputs_valid, labels_valid, num_classes=num_classes)
+            # Compute loss based on mode
+            if use_ordinal:
+                # CORN ordinal loss, computed on the dense [B, num_classes-1, H, W] map
+                loss = corn_loss_masked(outputs, part_labels, valid_mask[part].to(device))
+            else:
+                # Standard categorical cross-entropy
+                loss = criterion(outputs, part_labels, part_masks)
             
-        else:
-            # Standard categorical cross-entropy
-            loss = criterion(outputs, labels, masks)
+            # Check loss
+            if torch.isnan(loss) or torch.isinf(loss):
+                problem = "loss"
+                break
+            
+            if len(parts) > 1:
+                (loss * share).backward()                       # accumulate gradients
+            else:
+                loss.backward()
+            batch_loss += loss.item() * share
         
-        # Check loss
-        if torch.isnan(loss) or torch.isinf(loss):
-            print(f"  WARNING: NaN/Inf loss at batch {batch_idx}")
+        if problem is not None:
+            print(f"  WARNING: NaN/Inf {problem} at batch {batch_idx}")
             nan_count += 1
             continue
         
-        loss.backward()
         grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_norm)
         optimizer.step()
         
-        running_loss += loss.item()
+        running_loss += batch_loss
     
     epoch_loss = running_loss / (len(dataloader) - nan_count) if (len(dataloader) - nan_count) > 0 else float('nan')
     
@@ -258,22 +289,14 @@ def validate(model, dataloader, criterion, device, config):
             
             # Get predictions based on mode
             if use_ordinal:
-                # CORAL: convert logits to predicted class
-                # outputs: [B, num_classes-1, H, W]
-                B, C, H, W = outputs.shape
-                outputs_flat = outputs.permute(0, 2, 3, 1).reshape(-1, C)
-                predicted_flat = corn_label_from_logits(outputs_flat)
-                predicted = predicted_flat.reshape(B, H, W)
+                # CORN: convert logits [B, num_classes-1, H, W] to predicted class
+                predicted = corn_label(outputs)
                 
                 # Compute loss (optional, for tracking)
-                labels_masked = labels.clone()
-                labels_masked[masks == 0] = ignore_index
-                valid_mask = (labels_masked != ignore_index).reshape(-1)
+                valid_mask = (masks != 0) & (labels != ignore_index)
                 
                 if valid_mask.sum() > 0:
-                    outputs_valid = outputs_flat[valid_mask]
-                    labels_valid = labels_masked.reshape(-1)[valid_mask]
-                    loss = corn_loss(outputs_valid, labels_valid, num_classes=num_classes)
+                    loss = corn_loss_masked(outputs, labels, valid_mask)
                     
                     if not (torch.isnan(loss) or torch.isinf(loss)):
                         running_loss += loss.item()
@@ -317,20 +340,172 @@ def validate(model, dataloader, criterion, device, config):
     return epoch_loss, overall_acc, class_acc
 
 
-# Part 6: Main training loop
+# Part 6: Shared helpers (also used by train_replicates.py)
+
+def load_split(data_dir, site, dataset):
+    """Patches, labels and masks for one split ('train', 'validate' or 'test')"""
+    return tuple(np.load(os.path.join(data_dir, f"{site}_{dataset}_{part}.npy"))
+                 for part in ('patches', 'labels', 'masks'))
+
+
+def warmup_lr(optimizer, learning_rate, epoch, warmup_epochs):
+    """Set the learning rate for an epoch of a linear warm-up: learning_rate *
+    (epoch + 1) / (warmup_epochs + 1) for the first warmup_epochs epochs, then
+    learning_rate. Returns the rate set."""
+    lr = learning_rate * min(1.0, (epoch + 1) / (warmup_epochs + 1)) if warmup_epochs else learning_rate
+    for group in optimizer.param_groups:
+        group['lr'] = lr
+    return lr
+
+
+def class_weight_vector(class_pixel_counts, num_classes, class_weighting='freq', class_weights=None):
+    """
+    Class weights for the masked cross-entropy loss
+    
+    Args:
+        class_pixel_counts: Labeled training pixels per class
+        num_classes: Number of classes
+        class_weighting: 'none', 'freq', or 'sqrt'
+        class_weights: Optional pinned weight vector, used verbatim
+    
+    Returns:
+        (class_weights, class_weighting), with class_weighting 'pinned' for
+        supplied weights
+    """
+    if class_weights is not None:
+        # Pinned weights supplied by the caller: use verbatim, do NOT recompute or
+        # renormalize (they are already normalized upstream). This fixes the loss
+        # weighting across runs (e.g. every radius in the degrade experiment shares
+        # the full-transect weights) so weighting can't confound the comparison.
+        class_weights = np.asarray(class_weights, dtype=float).ravel()
+        if class_weights.shape[0] != num_classes:
+            raise ValueError(f"class_weights has length {class_weights.shape[0]} but num_classes={num_classes}")
+        return class_weights, 'pinned'
+    
+    match class_weighting:
+        case 'none':
+            class_weights = np.ones(num_classes)
+        case 'freq':
+            class_weights = 1.0 / (class_pixel_counts + 1e-6)
+        case 'sqrt':
+            class_weights = 1.0 / np.sqrt(class_pixel_counts + 1e-6)
+        case _:
+            raise ValueError(f"class_weighting must be 'none', 'freq', or 'sqrt'; got '{class_weighting}'")
+    
+    return class_weights / class_weights.sum() * num_classes, class_weighting
+
+
+def new_history(num_classes):
+    """Empty per-epoch metrics history"""
+    return {
+        'train_loss': [],
+        'val_loss': [],
+        'val_ccr': [],
+        'class_ccr': {c: [] for c in range(num_classes)},
+        'test_epochs': [],
+        'test_ccr': [],
+        'test_class_ccr': {c: [] for c in range(num_classes)},
+    }
+
+
+def add_eval_results(history, epoch, results, num_classes):
+    """Add one epoch's validate() results ({'validate': ..., 'test': ...}, either optional) to history"""
+    if 'validate' in results:
+        validate_loss, validate_acc, class_acc = results['validate']
+        history['val_loss'].append(validate_loss)
+        history['val_ccr'].append(validate_acc)
+        for c in range(num_classes):
+            history['class_ccr'][c].append(class_acc[c])
+    if 'test' in results:
+        _, test_acc, test_class_acc = results['test']
+        history['test_epochs'].append(epoch + 1)
+        history['test_ccr'].append(test_acc)
+        for c in range(num_classes):
+            history['test_class_ccr'][c].append(test_class_acc[c])
+
+
+def best_ccrs(history):
+    """(best_val_ccr, best_val_epoch, best_test_ccr, best_test_epoch), None where not run"""
+    if history['val_ccr']:
+        best_val_ccr   = max(history['val_ccr'])
+        best_val_epoch = history['val_ccr'].index(best_val_ccr) + 1
+    else:
+        best_val_ccr = best_val_epoch = None
+
+    if history['test_ccr']:
+        best_test_ccr   = max(history['test_ccr'])
+        best_test_epoch = history['test_epochs'][history['test_ccr'].index(best_test_ccr)]
+    else:
+        best_test_ccr = best_test_epoch = None
+    return best_val_ccr, best_val_epoch, best_test_ccr, best_test_epoch
+
+
+def save_fit(state_dict, output_dir, site, config):
+    """
+    Save final weights to <output_dir>/unet_<SITE>_final.pth and the model
+    config one level up, at the fit level; returns the weights path
+    """
+    import json
+    os.makedirs(output_dir, exist_ok=True)
+    fit_dir     = os.path.dirname(output_dir)           # one level up: <model>/<result>/
+    os.makedirs(fit_dir, exist_ok=True)
+    model_path  = os.path.join(output_dir, f"unet_{site.upper()}_final.pth")
+    config_path = os.path.join(fit_dir,    f"unet_{site.upper()}_config.json")
+
+    torch.save(state_dict, model_path)
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    return model_path
+
+
+def write_training_metrics(metrics_path, history, n_epochs, original_classes):
+    """Write training_metrics.csv (one row per epoch) for R plotting"""
+    import csv
+    num_classes = len(original_classes)
+    has_val = len(history['val_ccr']) > 0
+    class_col_names = [f'test_ccr_class{int(original_classes[c])}' for c in range(num_classes)]
+    header = ['epoch', 'train_loss', 'val_loss', 'val_ccr', 'test_ccr'] + class_col_names
+    test_epoch_lookup = {ep: idx for idx, ep in enumerate(history['test_epochs'])}
+
+    with open(metrics_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=header)
+        writer.writeheader()
+        for ep_idx in range(n_epochs):
+            ep = ep_idx + 1
+            row = {
+                'epoch':      ep,
+                'train_loss': history['train_loss'][ep_idx],
+                'val_loss':   history['val_loss'][ep_idx] if has_val else '',
+                'val_ccr':    history['val_ccr'][ep_idx]  if has_val else '',
+                'test_ccr':   '',
+            }
+            for col in class_col_names:
+                row[col] = ''
+            if ep in test_epoch_lookup:
+                test_idx = test_epoch_lookup[ep]
+                row['test_ccr'] = history['test_ccr'][test_idx]
+                for c in range(num_classes):
+                    row[class_col_names[c]] = history['test_class_ccr'][c][test_idx]
+            writer.writerow(row)
+
+
+# Part 7: Main training loop
 
 def train_unet(site, data_dir, output_dir="models", original_classes=None,
     encoder_name="resnet18", encoder_weights=None, learning_rate=0.0001,
     weight_decay=1e-4, class_weighting = 'freq', n_epochs=50, batch_size=8,
     gradient_clip_max_norm=1.0, num_classes=4, in_channels=None,
     use_ordinal=False, test_interval=5, requirecuda=True, seed=42,
-    class_weights=None):
+    class_weights=None, memory_budget_gb=None, micro_batch_size=None,
+    activation_checkpointing=False, freeze_encoder=False, feature_cache_gb=20,
+    async_eval=False, eval_device=None, carve_radius=None, carve_plots=None,
+    init_from=None, init_scope='all', warmup_epochs=0, sources=None, site_weights=None):
     """
     Main training function
     
     Args:
         site: Site's 3-letter code (e.g., "nor")
-        data_dir: Directory containing numpy files
+        data_dir: Directory containing numpy files (ignored with sources)
         output_dir: Where to save trained model and diagnostic plots
         original_classes: List mapping internal indices to original class numbers
         encoder_name: Pre-trained encoder to use   
@@ -344,17 +519,74 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
             pixel-degradation experiment fixes them to the full-transect frequency so
             the loss is not radius-dependent). Default None = compute from this run.
         n_epochs: Number of training epochs
-        batch_size: Batch size for training
+        batch_size: Batch size for training. With memory_budget_gb or
+            micro_batch_size this is the effective batch size, reached by
+            gradient accumulation over smaller micro-batches
         gradient_clip_max_norm: Gradient clipping threshold
         num_classes: Number of classes to fit
         in_channels: Number of input channels
         plot_curves: Create diagnostic plots?
-        use_ordinal: Use ordinal regression for ordered classes (requires coral_pytorch)
+        use_ordinal: Use ordinal regression (CORN) for ordered classes
+        memory_budget_gb: GPU memory budget in GB, or 'auto' (90% of the device).
+            When given, the largest micro-batch (up to batch_size) whose training
+            step fits the budget is found by probing. None = no probing
+        micro_batch_size: Explicit micro-batch size (skips probing)
+        activation_checkpointing: Recompute encoder stage and decoder block
+            activations in the backward pass to save memory (slower)
+        freeze_encoder: Train only the decoder and segmentation head, with the
+            encoder's weights and BatchNorm statistics fixed (use with
+            encoder_weights='imagenet' or a pretrained encoder). Encoder
+            features of each training patch under each of the 8 rotations/flips
+            are cached on disk (see feature_cache.py), so epochs after the
+            first run only the decoder
+        feature_cache_gb: Size cap for the encoder feature cache; 0 disables
+            caching (the encoder is still frozen)
+        async_eval: Run each epoch's validation and test passes in a background
+            thread on a snapshot of the weights, overlapped with the next epoch
+            (see async_eval.py). Metrics are merged in epoch order, as for a
+            synchronous run. Validation augmentation then draws from its own
+            random stream, so results differ slightly from async_eval=False
+        eval_device: Device for async evaluation, e.g. 'cuda:1' or 'cpu'.
+            Default: the last GPU if there are several, else the training device
+        carve_radius: Carve training labels to disks of this radius (map units)
+            around plot centers at load time, from the per-pixel plot distance
+            arrays exported with a full-transect patch set (see carving.py).
+            Validation and test labels are not carved. None = no carving
+        carve_plots: Optional plot ids to keep when carving
+        init_from: Warm-start from this .pth (e.g. the previous CV fold's
+            fit) instead of encoder_weights; tensors are matched by key, and
+            any with mismatched shapes are left at their initial values and
+            reported (see unet_models.init_unet_from). The source and what was
+            loaded are logged in class_weights.json ('init'; null when
+            training from scratch). None = no warm start
+        init_scope: 'all' to load the whole model from init_from, or
+            'encoder' for just the encoder
+        warmup_epochs: Ramp the learning rate linearly up to learning_rate
+            over this many epochs (see warmup_lr); 0 = none
+        sources: Train on several sites' exports at once: a list of (site,
+            data_dir) pairs (or dicts with 'site' and 'data_dir'), which must
+            all have the same in_channels. Each split is read memory-mapped as
+            one virtual dataset rather than concatenated (see multisite.py),
+            and per-site validation and test CCR of the final model are
+            written to site_metrics.csv. site then only names the fit. None =
+            train on data_dir alone
+        site_weights: With sources, relative sampling weight of each site (a
+            list in source order, or a dict of site: weight), independent of
+            its number of patches; each epoch draws as many patches as there
+            are, with replacement. None = draw every patch once
     """
     
     # Read in_channels from metadata JSON if not supplied
     import json
-    if in_channels is None:
+    if sources is not None:
+        if carve_radius is not None or carve_plots is not None:
+            raise ValueError("Label carving is not supported with multiple sources")
+        sources = read_sources(sources, in_channels)
+        in_channels = sources[0]['in_channels']
+        print(f"Sources: {', '.join(s['site'] for s in sources)} ({in_channels} input channels)")
+    elif site_weights is not None:
+        raise ValueError("site_weights requires sources")
+    elif in_channels is None:
         metadata_path = os.path.join(data_dir, f"{site}_metadata.json")
         with open(metadata_path) as f:
             metadata = json.load(f)
@@ -370,10 +602,6 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
     
     # Validate ordinal mode
     if use_ordinal:
-        if not CORAL_AVAILABLE:
-            raise ImportError("Ordinal regression requires coral_pytorch. "
-                            "Install with: pip install coral-pytorch")
-        
         # Check that classes are sequential
         if original_classes is not None:
             sorted_classes = sorted(original_classes)
@@ -419,48 +647,59 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
     print(f"Using device: {device}")
     
     # Load data
-    print("\nLoading training data...")
-    train_patches = np.load(os.path.join(data_dir, f"{site}_train_patches.npy"))
-    train_labels = np.load(os.path.join(data_dir, f"{site}_train_labels.npy"))
-    train_masks = np.load(os.path.join(data_dir, f"{site}_train_masks.npy"))
+    if sources is not None:
+        # Memory-mapped, per source; nothing is concatenated
+        print("\nOpening training, validation and test data...")
+        sites = [s['site'] for s in sources]
+        splits = {name: [open_split(s['data_dir'], s['site'], name) for s in sources]
+                  for name in ('train', 'validate', 'test')}
+        carve_log = None
+        
+        print("\nCalculating class weights...")
+        class_pixel_counts, label_values = split_class_counts(splits['train'], num_classes)
+        print(f"\nUnique label values: {label_values}")
+        assert len(label_values) == num_classes, f"Found {len(label_values)} classes but expected {num_classes}"
+    else:
+        print("\nLoading training data...")
+        train_patches, train_labels, train_masks = load_split(data_dir, site, 'train')
+        carve_log = None
+        if carve_radius is not None or carve_plots is not None:
+            train_patches, train_labels, train_masks, carve_log = carve_train_split(
+                data_dir, site, train_patches, train_labels, train_masks, carve_radius, carve_plots)
     
-    print(f"Train patches - any Inf: {np.isinf(train_patches).any()}")
-    print(f"Train patches - any NaN: {np.isnan(train_patches).any()}")
+        print(f"Train patches - any Inf: {np.isinf(train_patches).any()}")
+        print(f"Train patches - any NaN: {np.isnan(train_patches).any()}")
     
-    print("Loading validation data...")
-    validate_patches = np.load(os.path.join(data_dir, f"{site}_validate_patches.npy"))
-    validate_labels = np.load(os.path.join(data_dir, f"{site}_validate_labels.npy"))
-    validate_masks = np.load(os.path.join(data_dir, f"{site}_validate_masks.npy"))
+        print("Loading validation data...")
+        validate_patches, validate_labels, validate_masks = load_split(data_dir, site, 'validate')
 
-    print("Loading test data...")
-    test_patches = np.load(os.path.join(data_dir, f"{site}_test_patches.npy"))
-    test_labels = np.load(os.path.join(data_dir, f"{site}_test_labels.npy"))
-    test_masks = np.load(os.path.join(data_dir, f"{site}_test_masks.npy"))
+        print("Loading test data...")
+        test_patches, test_labels, test_masks = load_split(data_dir, site, 'test')
     
-    # Check input data 
-    print("\nInput data ranges:")
-    for c in range(train_patches.shape[3]):
-        c_data = train_patches[:, :, :, c]
-        print(f"  Channel {c}: min={c_data.min():.4f}, max={c_data.max():.4f}, "
-              f"mean={c_data.mean():.4f}, std={c_data.std():.4f}")
+        # Check input data 
+        print("\nInput data ranges:")
+        for c in range(train_patches.shape[3]):
+            c_data = train_patches[:, :, :, c]
+            print(f"  Channel {c}: min={c_data.min():.4f}, max={c_data.max():.4f}, "
+                  f"mean={c_data.mean():.4f}, std={c_data.std():.4f}")
     
-    print(f"\nNaN in patches: {np.isnan(train_patches).any()}")
-    print(f"Inf in patches: {np.isinf(train_patches).any()}")
-    print(f"NaN in labels: {np.isnan(train_labels).any()}")
+        print(f"\nNaN in patches: {np.isnan(train_patches).any()}")
+        print(f"Inf in patches: {np.isinf(train_patches).any()}")
+        print(f"NaN in labels: {np.isnan(train_labels).any()}")
     
-    unique_labels = np.unique(train_labels)
-    print(f"\nUnique label values: {unique_labels}")
+        unique_labels = np.unique(train_labels)
+        print(f"\nUnique label values: {unique_labels}")
     
-    actual_classes = len(np.unique(train_labels[train_labels != 255]))
-    assert actual_classes == num_classes, f"Found {actual_classes} classes but expected {num_classes}"
+        actual_classes = len(np.unique(train_labels[train_labels != 255]))
+        assert actual_classes == num_classes, f"Found {actual_classes} classes but expected {num_classes}"
     
-    # Calculate class weights (not used in ordinal mode)
-    print("\nCalculating class weights...")
-    class_pixel_counts = np.zeros(num_classes)
+        # Calculate class weights (not used in ordinal mode)
+        print("\nCalculating class weights...")
+        class_pixel_counts = np.zeros(num_classes)
     
-    for c in range(num_classes):
-        count = ((train_labels == c) & (train_masks == 1)).sum()
-        class_pixel_counts[c] = float(count)
+        for c in range(num_classes):
+            count = ((train_labels == c) & (train_masks == 1)).sum()
+            class_pixel_counts[c] = float(count)
     
     print(f"\nClass pixel counts:")
     for i in range(num_classes):
@@ -471,40 +710,28 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
         print(f"\nWARNING: Classes {zero_classes} have ZERO training pixels!")
     
     
-    if class_weights is not None:
-        # Pinned weights supplied by the caller: use verbatim, do NOT recompute or
-        # renormalize (they are already normalized upstream). This fixes the loss
-        # weighting across runs (e.g. every radius in the degrade experiment shares
-        # the full-transect weights) so weighting can't confound the comparison.
-        class_weights = np.asarray(class_weights, dtype=float).ravel()
-        if class_weights.shape[0] != num_classes:
-            raise ValueError(f"class_weights has length {class_weights.shape[0]} but num_classes={num_classes}")
-        class_weighting = 'pinned'
-    else:
-        match class_weighting:
-            case 'none':
-                class_weights = np.ones(num_classes)
-            case 'freq':
-                class_weights = 1.0 / (class_pixel_counts + 1e-6)
-            case 'sqrt':
-                class_weights = 1.0 / np.sqrt(class_pixel_counts + 1e-6)
-            case _:
-                raise ValueError(f"class_weighting must be 'none', 'freq', or 'sqrt'; got '{class_weighting}'")
-
-        class_weights = class_weights / class_weights.sum() * num_classes
+    class_weights, class_weighting = class_weight_vector(class_pixel_counts, num_classes,
+                                                         class_weighting, class_weights)
 
     # Log the computed weights + training pixel counts so callers (e.g. the
     # pixel-degradation experiment) can record how carving shifted them.
     import json
     os.makedirs(output_dir, exist_ok=True)
+    run_log = {
+        "seed": seed,
+        "class_weighting": class_weighting,
+        "original_classes": [int(c) for c in original_classes],
+        "class_pixel_counts": [float(x) for x in class_pixel_counts],
+        "class_weights": [float(x) for x in class_weights],
+    }
+    if carve_log is not None:
+        run_log["carve"] = carve_log
+    if sources is not None:
+        run_log["sources"] = [{"site": s['site'], "data_dir": s['data_dir'], "n_train": len(p)}
+                              for s, (p, _, _) in zip(sources, splits['train'])]
+        run_log["site_weights"] = site_weights
     with open(os.path.join(output_dir, "class_weights.json"), "w") as _wf:
-        json.dump({
-            "seed": seed,
-            "class_weighting": class_weighting,
-            "original_classes": [int(c) for c in original_classes],
-            "class_pixel_counts": [float(x) for x in class_pixel_counts],
-            "class_weights": [float(x) for x in class_weights],
-        }, _wf, indent=2)
+        json.dump(run_log, _wf, indent=2)
 
     if use_ordinal:
         print(f"\nOrdinal mode: class weights NOT used")
@@ -513,13 +740,24 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
     
     # Create datasets
     print("\nCreating datasets...")
-    train_dataset = MaskedPatchDataset(train_patches, train_labels, train_masks)
-    validate_dataset = MaskedPatchDataset(validate_patches, validate_labels, validate_masks)
-    test_dataset = MaskedPatchDataset(test_patches, test_labels, test_masks, augment=False)
+    if sources is not None:
+        train_dataset = MultiSiteDataset(splits['train'], sites,
+                                         return_index=freeze_encoder and feature_cache_gb > 0)
+        validate_dataset = MultiSiteDataset(splits['validate'], sites,
+                                            rng=random.Random(seed + 1) if async_eval else None)
+        test_dataset = MultiSiteDataset(splits['test'], sites, augment=False)
+    else:
+        train_dataset = MaskedPatchDataset(train_patches, train_labels, train_masks,
+                                           return_index=freeze_encoder and feature_cache_gb > 0)
+        validate_dataset = MaskedPatchDataset(validate_patches, validate_labels, validate_masks,
+                                              rng=random.Random(seed + 1) if async_eval else None)
+        test_dataset = MaskedPatchDataset(test_patches, test_labels, test_masks, augment=False)
 
     loader_generator = torch.Generator()                         # make shuffle order depend on `seed`
     loader_generator.manual_seed(seed)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, generator=loader_generator)
+    sampler = None if site_weights is None else site_sampler(train_dataset, site_weights, loader_generator)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=sampler is None,
+                              sampler=sampler, generator=loader_generator)
     validate_loader = DataLoader(validate_dataset, batch_size=batch_size, shuffle=False)
     test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
 
@@ -536,64 +774,98 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
     print(f"Encoder: {encoder_name}")
     print(f"Encoder weights: {encoder_weights}")
     
-    # Create model
+    # Create model (ordinal: num_classes - 1 outputs, CORAL convention)
     print("\nBuilding U-Net model...")
-    import segmentation_models_pytorch as smp
-
+    model = build_unet(encoder_name, in_channels, num_classes,
+                       use_ordinal=use_ordinal, encoder_weights=encoder_weights)
     if use_ordinal:
-        # Ordinal: num_classes - 1 outputs (cumulative thresholds)
-        model = smp.Unet(
-           encoder_name=encoder_name,
-           encoder_weights=encoder_weights,
-           in_channels=in_channels,
-           classes=num_classes - 1,  # CORAL convention
-        )
         print(f"  Using CORAL ordinal regression ({num_classes-1} cumulative thresholds)")
     else:
-        # Standard: num_classes outputs
-        model = smp.Unet(
-           encoder_name=encoder_name,
-           encoder_weights=encoder_weights,
-           in_channels=in_channels,
-           classes=num_classes,
-        )
         print(f"  Using standard categorical classification ({num_classes} classes)")
+    init_log = init_unet_from(model, init_from, init_scope) if init_from is not None else None
+    
+    if freeze_encoder:
+        for p in model.encoder.parameters():
+            p.requires_grad = False
+        n_trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        print(f"  Encoder frozen: training decoder and head only ({n_trainable:,} parameters)")
     
-    # Multi-GPU
-    if torch.cuda.device_count() > 1:
+    # Multi-GPU (not with a frozen encoder: the feature cache feeds a single model)
+    if torch.cuda.device_count() > 1 and not freeze_encoder:
         print(f"Using {torch.cuda.device_count()} GPUs with DataParallel")
         model = nn.DataParallel(model)
     
     model = model.to(device)
     
+    # Fit the batch into memory: optional activation checkpointing, then a
+    # micro-batch size (explicit, probed against the memory budget, or the
+    # whole batch) and the gradient accumulation steps to reach batch_size
+    if activation_checkpointing:
+        n_checkpointed = enable_checkpointing(model)
+        print(f"Activation checkpointing on {n_checkpointed} encoder/decoder blocks")
+    probe_peak_gb = None
+    if micro_batch_size is not None:
+        micro_batch_size = max(1, min(int(micro_batch_size), batch_size))
+    elif memory_budget_gb is not None and device.type == 'cuda':
+        budget = device_budget_bytes(device, memory_budget_gb)
+        print(f"Probing micro-batch size for a {budget / 1024 ** 3:.1f} GB memory budget...")
+        micro_batch_size, peak = probe_micro_batch(model, tuple(train_dataset.patches.shape[1:]),
+                                                   device, batch_size, budget)
+        probe_peak_gb = peak / 1024 ** 3
+    else:
+        if memory_budget_gb is not None:
+            print("memory_budget_gb ignored: not training on a GPU")
+        micro_batch_size = batch_size
+    accumulation_steps = -(-batch_size // micro_batch_size)
+    print(f"Batch size {batch_size}: micro-batch {micro_batch_size} x {accumulation_steps} accumulation step(s)")
+    
+    run_log.update({
+        "batch_size": batch_size,
+        "micro_batch_size": micro_batch_size,
+        "accumulation_steps": accumulation_steps,
+        "memory_budget_gb": memory_budget_gb,
+        "probe_peak_gb": probe_peak_gb,
+        "activation_checkpointing": bool(activation_checkpointing),
+        "freeze_encoder": bool(freeze_encoder),
+        "async_eval": bool(async_eval),
+        "init": init_log,
+        "warmup_epochs": int(warmup_epochs),
+    })
+    with open(os.path.join(output_dir, "class_weights.json"), "w") as _wf:
+        json.dump(run_log, _wf, indent=2)
+    
     # Loss function
     if use_ordinal:
-        criterion = None  # CORAL loss computed directly in training loop
+        criterion = None  # CORN loss computed directly in training loop (ordinal.py)
     else:
         class_weights_tensor = torch.FloatTensor(class_weights).to(device)
         criterion = MaskedCrossEntropyLoss(weight=class_weights_tensor, ignore_index=255)
     
     # Optimizer
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad],
+                                 lr=learning_rate, weight_decay=weight_decay)
+    
+    # Encoder feature cache for frozen-encoder training
+    feature_cache = None
+    if freeze_encoder and feature_cache_gb > 0:
+        model.encoder.eval()
+        feature_cache = FeatureCache(model, os.path.join(output_dir, 'feature_cache'), len(train_dataset),
+                                     tuple(train_dataset.patches.shape[1:]), device, max_gb=feature_cache_gb)
     
     # Training configuration
     training_config = {
         'use_ordinal': use_ordinal,
         'num_classes': num_classes,
         'ignore_index': 255,
-        'gradient_clip_max_norm': gradient_clip_max_norm
+        'gradient_clip_max_norm': gradient_clip_max_norm,
+        'micro_batch_size': micro_batch_size if accumulation_steps > 1 else None,
+        'class_weights': None if use_ordinal else class_weights_tensor,
+        'freeze_encoder': freeze_encoder,
+        'feature_cache': feature_cache
     }
     
     # Track metrics
-    history = {
-        'train_loss': [],
-        'val_loss': [],
-        'val_ccr': [],
-        'class_ccr': {c: [] for c in range(num_classes)},
-        'test_epochs': [],
-        'test_ccr': [],
-        'test_class_ccr': {c: [] for c in range(num_classes)},
-    }
+    history = new_history(num_classes)
     
     print("\n" + "="*60)
     print("Starting training...")
@@ -606,27 +878,14 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
     progress_path = os.path.join(output_dir, 'progress.txt')
     progress_file = open(progress_path, 'w')
 
-    for epoch in range(n_epochs):
-        # Train
-        train_loss = train_one_epoch(model, train_loader, criterion, optimizer, device, training_config)
-        history['train_loss'].append(train_loss)
-
-        # Validate
+    def record_epoch(epoch, train_loss, results):
+        """Add one epoch's metrics to history and report them"""
+        add_eval_results(history, epoch, results, num_classes)
         if has_val:
-            validate_loss, validate_acc, class_acc = validate(model, validate_loader, criterion, device, training_config)
-            history['val_loss'].append(validate_loss)
-            history['val_ccr'].append(validate_acc)
-            for c in range(num_classes):
-                history['class_ccr'][c].append(class_acc[c])
-
-        # Test (every test_interval epochs)
-        run_test = has_test and ((epoch + 1) % test_interval == 0 or epoch == n_epochs - 1)
+            validate_loss, validate_acc, class_acc = results['validate']
+        run_test = 'test' in results
         if run_test:
-            _, test_acc, test_class_acc = validate(model, test_loader, criterion, device, training_config)
-            history['test_epochs'].append(epoch + 1)
-            history['test_ccr'].append(test_acc)
-            for c in range(num_classes):
-                history['test_class_ccr'][c].append(test_class_acc[c])
+            test_acc = results['test'][1]
 
         # Print progress
         if has_val:
@@ -652,35 +911,58 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
         progress_file.write(line + '\n')
         progress_file.flush()
 
-    progress_file.close()
+    # Background evaluation on a separate copy of the model
+    evaluator = None
+    if async_eval:
+        device_eval = choose_eval_device(device, eval_device)
+        eval_criterion = None if use_ordinal else \
+            MaskedCrossEntropyLoss(weight=class_weights_tensor.to(device_eval), ignore_index=255)
+        evaluator = AsyncEvaluator(
+            build_unet(encoder_name, in_channels, num_classes, use_ordinal=use_ordinal),
+            lambda m, loader: validate(m, loader, eval_criterion, device_eval, training_config),
+            device_eval)
+        print(f"Validation and test evaluation run in the background on {device_eval}")
 
-    # Compute best CCR summaries from history
-    if has_val and history['val_ccr']:
-        best_val_ccr   = max(history['val_ccr'])
-        best_val_epoch = history['val_ccr'].index(best_val_ccr) + 1
-    else:
-        best_val_ccr = best_val_epoch = None
+    for epoch in range(n_epochs):
+        # Train
+        if warmup_epochs:
+            warmup_lr(optimizer, learning_rate, epoch, warmup_epochs)
+        train_loss = train_one_epoch(model, train_loader, criterion, optimizer, device, training_config)
+        history['train_loss'].append(train_loss)
 
-    if has_test and history['test_ccr']:
-        best_test_ccr   = max(history['test_ccr'])
-        best_test_epoch = history['test_epochs'][history['test_ccr'].index(best_test_ccr)]
-    else:
-        best_test_ccr = best_test_epoch = None
+        # Validate, and test every test_interval epochs
+        loaders = {}
+        if has_val:
+            loaders['validate'] = validate_loader
+        if has_test and ((epoch + 1) % test_interval == 0 or epoch == n_epochs - 1):
+            loaders['test'] = test_loader
+
+        if evaluator is not None:
+            evaluator.submit(epoch, model, loaders)
+            for done_epoch, results in evaluator.results():
+                record_epoch(done_epoch, history['train_loss'][done_epoch], results)
+        else:
+            results = {name: validate(model, loader, criterion, device, training_config)
+                       for name, loader in loaders.items()}
+            record_epoch(epoch, train_loss, results)
 
-    # Save final model
-    os.makedirs(output_dir, exist_ok=True)
-    fit_dir     = os.path.dirname(output_dir)           # one level up: <model>/<result>/
-    os.makedirs(fit_dir, exist_ok=True)
-    model_path  = os.path.join(output_dir, f"unet_{site.upper()}_final.pth")
-    config_path = os.path.join(fit_dir,    f"unet_{site.upper()}_config.json")
+    if evaluator is not None:
+        for done_epoch, results in evaluator.results(wait=True):
+            record_epoch(done_epoch, history['train_loss'][done_epoch], results)
+        evaluator.close()
 
-    if isinstance(model, nn.DataParallel):
-        torch.save(model.module.state_dict(), model_path)
-    else:
-        torch.save(model.state_dict(), model_path)
+    progress_file.close()
 
-    import json
-    config = {
+    if feature_cache is not None:
+        print(f"Encoder feature cache: {feature_cache.hits} hits, {feature_cache.misses} misses")
+        feature_cache.close()
+
+    # Compute best CCR summaries from history
+    best_val_ccr, best_val_epoch, best_test_ccr, best_test_epoch = best_ccrs(history)
+
+    # Save final model and config, and write training metrics CSV for R plotting
+    model_path = save_fit(model.module.state_dict() if isinstance(model, nn.DataParallel) else model.state_dict(),
+                          output_dir, site, {
         'encoder_name': encoder_name,
         'encoder_weights': encoder_weights,
         'in_channels': in_channels,
@@ -688,37 +970,13 @@ def train_unet(site, data_dir, output_dir="models", original_classes=None,
         'original_classes': original_classes,
         'site': site,
         'use_ordinal': use_ordinal
-    }
-    with open(config_path, 'w') as f:
-        json.dump(config, f, indent=2)
-
-    # Write training metrics CSV for R plotting
-    import csv
+    })
     metrics_path = os.path.join(output_dir, 'training_metrics.csv')
-    class_col_names = [f'test_ccr_class{int(original_classes[c])}' for c in range(num_classes)]
-    header = ['epoch', 'train_loss', 'val_loss', 'val_ccr', 'test_ccr'] + class_col_names
-    test_epoch_lookup = {ep: idx for idx, ep in enumerate(history['test_epochs'])}
-
-    with open(metrics_path, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=header)
-        writer.writeheader()
-        for ep_idx in range(n_epochs):
-            ep = ep_idx + 1
-            row = {
-                'epoch':      ep,
-                'train_loss': history['train_loss'][ep_idx],
-                'val_loss':   history['val_loss'][ep_idx] if has_val else '',
-                'val_ccr':    history['val_ccr'][ep_idx]  if has_val else '',
-                'test_ccr':   '',
-            }
-            for col in class_col_names:
-                row[col] = ''
-            if ep in test_epoch_lookup:
-                test_idx = test_epoch_lookup[ep]
-                row['test_ccr'] = history['test_ccr'][test_idx]
-                for c in range(num_classes):
-                    row[class_col_names[c]] = history['test_class_ccr'][c][test_idx]
-            writer.writerow(row)
+    write_training_metrics(metrics_path, history, n_epochs, original_classes)
+    if sources is not None:
+        site_metrics(model, {'validate': validate_dataset, 'test': test_dataset},
+                     lambda m, loader: validate(m, loader, criterion, device, training_config),
+                     batch_size, os.path.join(output_dir, 'site_metrics.csv'))
 
     print("\n" + "="*60)
     print("Training complete!")
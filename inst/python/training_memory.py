@@ -0,0 +1,181 @@
+"""
+GPU memory budgeting for U-Net training
+
+Helpers used by train_unet.py to fit a requested batch size into device
+memory:
+
+- probe_micro_batch() finds the largest micro-batch whose forward and
+  backward pass fits within a memory budget, by trial on the real model
+- train_unet() then splits each batch into micro-batches and accumulates
+  gradients, so the optimizer still sees the requested (effective) batch
+- enable_checkpointing() recomputes encoder stage and decoder block
+  activations during the backward pass instead of storing them, trading
+  compute for memory
+
+Checkpointing swaps each block's class for a checkpointing subclass of it,
+so the model's structure and state_dict keys are unchanged and saved weights
+load into a plain model as before. Because the override lives on the class,
+not the instance, nn.DataParallel replicas run their own weights on their
+own device.
+"""
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+class _Checkpointed:
+    """Mixin: run the module's own forward under activation checkpointing while training"""
+
+    def forward(self, *args, **kwargs):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super().forward, *args, use_reentrant=False, **kwargs)
+        return super().forward(*args, **kwargs)
+
+
+_CHECKPOINTED_CLASSES = {}
+
+
+def _checkpointed_class(cls):
+    """Checkpointing subclass of module class cls (one per class)"""
+    if cls not in _CHECKPOINTED_CLASSES:
+        _CHECKPOINTED_CLASSES[cls] = type(f'Checkpointed{cls.__name__}', (_Checkpointed, cls), {})
+    return _CHECKPOINTED_CLASSES[cls]
+
+
+def enable_checkpointing(model):
+    """
+    Turn on activation checkpointing for an smp.Unet's encoder stages and decoder blocks.
+
+    Encoder stages are the encoder's parameterized nn.Sequential children
+    (layer1..layer4 for ResNets); decoder blocks are model.decoder.blocks.
+    Note that BatchNorm layers inside checkpointed blocks run forward twice
+    per step in training, so their running statistics update twice.
+
+    Args:
+        model: smp.Unet (or nn.DataParallel wrapping one)
+
+    Returns:
+        Number of modules checkpointed
+    """
+    model = model.module if isinstance(model, nn.DataParallel) else model
+    targets = [m for m in model.encoder.children()
+               if isinstance(m, nn.Sequential) and any(True for _ in m.parameters())]
+    targets += list(getattr(model.decoder, 'blocks', []))
+    for m in targets:
+        if not isinstance(m, _Checkpointed):
+            m.__class__ = _checkpointed_class(type(m))
+    return len(targets)
+
+
+def device_budget_bytes(device, memory_budget_gb='auto'):
+    """Memory budget in bytes: 90% of the device for 'auto', else memory_budget_gb (capped at the device)"""
+    total = torch.cuda.get_device_properties(device).total_memory
+    if memory_budget_gb == 'auto':
+        return int(0.9 * total)
+    return min(int(float(memory_budget_gb) * 1024 ** 3), total)
+
+
+def probe_micro_batch(model, sample_shape, device, max_batch, budget_bytes):
+    """
+    Largest micro-batch (up to max_batch) whose training step fits in budget_bytes.
+
+    Each trial runs a forward and backward pass on a zero batch and measures
+    peak allocated memory, plus room for Adam's two moment buffers (allocated
+    at the first optimizer step). For nn.DataParallel, the micro-batch is split
+    across the GPUs as in training, and the peak is that of the fullest GPU. Batch sizes double until a trial fails or
+    exceeds the budget, then a binary search narrows the gap. Model weights,
+    BatchNorm statistics and gradients are restored afterwards, and no random
+    numbers are drawn, so probing doesn't change training results.
+
+    Args:
+        model: Model on device, in training mode (or nn.DataParallel wrapping one)
+        sample_shape: (C, H, W) of one input patch
+        device: CUDA device
+        max_batch: Requested (effective) batch size; no point probing beyond it
+        budget_bytes: Memory budget from device_budget_bytes()
+
+    Returns:
+        (micro_batch, peak_bytes) for the chosen micro-batch
+    """
+    state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    optimizer_bytes = 2 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+    devices = [torch.device('cuda', d) for d in model.device_ids] \
+        if isinstance(model, nn.DataParallel) else [device]     # every GPU holds a replica
+
+    def trial(b):
+        """Peak bytes for micro-batch b, or None if it doesn't fit"""
+        model.zero_grad(set_to_none=True)
+        torch.cuda.empty_cache()
+        for d in devices:
+            torch.cuda.reset_peak_memory_stats(d)
+        try:
+            x = torch.zeros((b,) + tuple(sample_shape), device=device)
+            model(x).float().square().mean().backward()
+            for d in devices:
+                torch.cuda.synchronize(d)
+            peak = max(torch.cuda.max_memory_allocated(d) for d in devices) + optimizer_bytes
+        except torch.cuda.OutOfMemoryError:
+            peak = None
+        finally:
+            x = None
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+        return peak if peak is not None and peak <= budget_bytes else None
+
+    model.train()
+    good, good_peak, bad = 0, None, None
+    b = 1
+    while b <= max_batch:
+        peak = trial(b)
+        if peak is None:
+            bad = b
+            break
+        good, good_peak = b, peak
+        if b == max_batch:
+            break
+        b = min(2 * b, max_batch)
+    if bad is not None:
+        lo, hi = good, bad
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            peak = trial(mid)
+            if peak is None:
+                hi = mid
+            else:
+                lo, good_peak = mid, peak
+        good = lo
+
+    model.load_state_dict(state)
+    if good == 0:
+        raise RuntimeError(f'A single patch of shape {tuple(sample_shape)} does not fit in the '
+                           f'{budget_bytes / 1024 ** 3:.1f} GB memory budget; '
+                           f'try activation_checkpointing=True or a smaller patch size')
+    return good, good_peak
+
+
+def loss_share(labels, valid, num_classes, use_ordinal, class_weights=None):
+    """
+    Denominator of a micro-batch's mean loss, used to weight micro-batches so
+    accumulated gradients equal those of the whole batch.
+
+    Masked cross-entropy with class weights averages over the weights of the
+    labeled pixels; the CORN loss averages over eligible (pixel, threshold)
+    pairs, min(y + 1, K - 1) per labeled pixel.
+
+    Args:
+        labels: [B, H, W] class labels
+        valid: [B, H, W] bool mask of labeled pixels
+        num_classes: Number of classes K
+        use_ordinal: CORN loss if True, else weighted cross-entropy
+        class_weights: Tensor of class weights (cross-entropy only)
+
+    Returns:
+        Float denominator
+    """
+    y = labels[valid].long()
+    if use_ordinal:
+        return float(torch.clamp(y + 1, max=num_classes - 1).sum())
+    if class_weights is None:
+        return float(y.numel())
+    return float(class_weights.to(y.device)[y].sum())
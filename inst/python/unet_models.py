@@ -0,0 +1,229 @@
+"""
+Shared U-Net model construction and loading
+
+One place to build the smp.Unet used by training and prediction, load saved
+weights consistently (weights_only, DataParallel 'module.' prefix stripped),
+warm-start a new fit from a prior one (init_unet_from), and keep recently used, ready-to-run models in a bounded LRU cache so repeated
+predictions (CV folds, ensemble maps, the persistent worker) don't rebuild and
+reload the same model every call.
+"""
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import torch
+import segmentation_models_pytorch as smp
+
+
+def load_config(config_path):
+    """Read a model config JSON written by train_unet()"""
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
+def model_classes(num_classes, use_ordinal):
+    """Number of output channels: K for categorical, K-1 thresholds for CORN"""
+    return num_classes - 1 if use_ordinal else num_classes
+
+
+def build_unet(encoder_name, in_channels, num_classes, use_ordinal=False, encoder_weights=None):
+    """Construct the U-Net architecture used throughout marshmap
+
+    Args:
+        encoder_name: smp encoder (e.g., 'resnet18')
+        in_channels: Number of input channels
+        num_classes: Number of classes K
+        use_ordinal: If True, K-1 output channels for CORN ordinal regression
+        encoder_weights: 'imagenet' or None (None when weights are loaded from file)
+
+    Returns:
+        smp.Unet model (on CPU)
+    """
+    return smp.Unet(
+        encoder_name=encoder_name,
+        encoder_weights=encoder_weights,
+        in_channels=in_channels,
+        classes=model_classes(num_classes, use_ordinal),
+    )
+
+
+def clean_state_dict(state_dict):
+    """Strip the DataParallel 'module.' prefix from state dict keys, if present"""
+    if any(k.startswith('module.') for k in state_dict):
+        state_dict = {(k[len('module.'):] if k.startswith('module.') else k): v
+                      for k, v in state_dict.items()}
+    return state_dict
+
+
+def load_state_dict(weights_path, device='cpu'):
+    """Load a saved state dict (tensors only) with any 'module.' prefix removed"""
+    state_dict = torch.load(weights_path, map_location=device, weights_only=True)
+    return clean_state_dict(state_dict)
+
+
+def init_unet_from(model, weights_path, scope='all'):
+    """Warm-start a model from saved weights, loading every tensor that matches
+
+    Tensors are matched by key; those whose shapes differ (e.g. the first
+    convolution when in_channels changed, or the head when num_classes did)
+    are left at their initial values and reported.
+
+    Args:
+        model: Freshly built U-Net (see build_unet())
+        weights_path: Path to a .pth state dict from a fit of the same
+            (or a compatible) architecture
+        scope: 'all' to load the whole model, or 'encoder' for just the encoder
+
+    Returns:
+        Dict describing the initialization, for logging: source path and file
+        hash, scope, tensors and parameters loaded, and the keys missing from
+        the source, with mismatched shapes, or unexpected in the model
+    """
+    if scope not in ('all', 'encoder'):
+        raise ValueError(f"init scope must be 'all' or 'encoder', not {scope!r}")
+    prefix = 'encoder.' if scope == 'encoder' else ''
+    source = load_state_dict(weights_path, 'cpu')
+    target = model.state_dict()
+
+    matched, mismatched, unexpected = {}, [], []
+    for k, v in source.items():
+        if not k.startswith(prefix):
+            continue
+        if k not in target:
+            unexpected.append(k)
+        elif tuple(v.shape) != tuple(target[k].shape):
+            mismatched.append({'key': k, 'model': list(target[k].shape), 'source': list(v.shape)})
+        else:
+            matched[k] = v
+    missing = [k for k in target if k.startswith(prefix) and k not in source]
+    model.load_state_dict(matched, strict=False)
+
+    h = hashlib.sha1()
+    with open(weights_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    n_loaded = sum(v.numel() for v in matched.values())
+    n_scope = sum(v.numel() for k, v in target.items() if k.startswith(prefix))
+    print(f'Initialized {scope} from {weights_path}: {len(matched)} tensors, '
+          f'{n_loaded:,} / {n_scope:,} values')
+    for m in mismatched:
+        print(f"  shape mismatch, left at init: {m['key']} model {m['model']} vs source {m['source']}")
+    if missing:
+        print(f'  {len(missing)} tensor(s) not in source, left at init: {", ".join(missing[:5])}'
+              f'{" ..." if len(missing) > 5 else ""}')
+    if unexpected:
+        print(f'  {len(unexpected)} source tensor(s) not in model, ignored')
+
+    return {
+        'source': os.path.abspath(weights_path),
+        'source_sha1': h.hexdigest()[:24],
+        'scope': scope,
+        'loaded_tensors': len(matched),
+        'loaded_values': int(n_loaded),
+        'scope_values': int(n_scope),
+        'missing': missing,
+        'shape_mismatch': mismatched,
+        'unexpected': unexpected,
+    }
+
+
+def load_unet(weights_path, config, device):
+    """Build a U-Net from its config, load weights, and ready it for inference
+
+    Args:
+        weights_path: Path to .pth state dict
+        config: Model config dict (from the training config JSON)
+        device: torch.device to put the model on
+
+    Returns:
+        Model in eval mode on device
+    """
+    model = build_unet(config['encoder_name'], config['in_channels'], config['num_classes'],
+                       use_ordinal=config.get('use_ordinal', False), encoder_weights=None)
+    model.load_state_dict(load_state_dict(weights_path, device))
+    model = model.to(device)
+    model.eval()
+    return model
+
+
+def model_bytes(model):
+    """Memory held by a model's parameters and buffers"""
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+class ModelCache:
+    """Bounded LRU cache of ready-to-run models
+
+    Keyed by weights path, file mtime, architecture and device, so a retrained
+    .pth at the same path is picked up automatically. Evicts least recently
+    used models when there are more than max_models, when they hold more than
+    max_gb, or (on CUDA) when free device memory drops below min_free_frac
+    of the total before loading another model.
+    """
+
+    def __init__(self, max_models=8, max_gb=4, min_free_frac=0.2):
+        self.max_models = max_models
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.min_free_frac = min_free_frac
+        self.models = OrderedDict()                              # key -> (model, bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(weights_path, config, device):
+        path = os.path.abspath(weights_path)
+        arch = (config['encoder_name'], config['in_channels'], config['num_classes'],
+                bool(config.get('use_ordinal', False)))
+        return (path, os.stat(path).st_mtime_ns, arch, str(device))
+
+    def get(self, weights_path, config, device):
+        """Return a cached model, loading (and caching) it on a miss"""
+        key = self.key(weights_path, config, device)
+        if key in self.models:
+            self.models.move_to_end(key)
+            self.hits += 1
+            return self.models[key][0]
+
+        self.misses += 1
+        for k in [k for k in self.models if k[0] == key[0]]:     # stale entries for a rewritten file
+            self._evict(k)
+        self._make_room(torch.device(device))
+        model = load_unet(weights_path, config, device)
+        self.models[key] = (model, model_bytes(model))
+        self._trim()
+        return model
+
+    def _evict(self, key):
+        del self.models[key]
+
+    def _trim(self):
+        while len(self.models) > self.max_models or \
+                (len(self.models) > 1 and sum(b for _, b in self.models.values()) > self.max_bytes):
+            self._evict(next(iter(self.models)))
+
+    def _make_room(self, device):
+        if device.type != 'cuda' or not torch.cuda.is_available():
+            return
+        while self.models:
+            free, total = torch.cuda.mem_get_info(device)
+            if free >= self.min_free_frac * total:
+                break
+            self._evict(next(iter(self.models)))
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        self.models.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+MODEL_CACHE = ModelCache()                                       # shared by every script in this process
+
+
+def get_model(weights_path, config, device, cache=True):
+    """Ready-to-run model for weights_path, from the shared LRU cache unless cache=False"""
+    if not cache:
+        return load_unet(weights_path, config, device)
+    return MODEL_CACHE.get(weights_path, config, device)
@@ -0,0 +1,213 @@
+"""
+Persistent local worker for U-Net training and prediction jobs
+
+Keeps torch, segmentation_models_pytorch and coral_pytorch imported and the
+CUDA context initialized across jobs, so R callers pay the Python startup cost
+once per session instead of once per fold or map. Recently used models stay
+loaded in the shared LRU cache (unet_models.MODEL_CACHE) between jobs.
+Started and driven from R via unet_worker_start() / unet_worker_call() /
+unet_worker_stop().
+
+Protocol: one JSON request per TCP connection on 127.0.0.1, newline-terminated,
+answered with one newline-terminated JSON response. Requests are handled one
+at a time; R pings with a short timeout and runs the job itself if the worker
+is busy with another session's job.
+
+    request:  {"token": "...", "op": "train" | "train_replicates" | "predict" | "predict_map" |
+                         "distill" | "tile_map" | "assemble_map" | "mosaic_roi" | "ping" |
+                         "shutdown",
+               "args": {...keyword arguments for the job...}}
+    response: {"ok": true, "result": ..., "elapsed": seconds}
+              {"ok": false, "error": "...", "traceback": "..."}
+
+Results are kept compact: file paths and summaries rather than whole arrays.
+Base R socket connections don't speak Unix domain sockets, so the worker
+listens on a loopback TCP port and requires the random token written to its
+(owner-only) state file.
+
+Usage: python unet_worker.py --state <state_file.json>
+"""
+
+import sys
+import os
+import json
+import time
+import secrets
+import argparse
+import traceback
+import socketserver
+
+if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(line_buffering=True)
+
+import numpy as np
+import torch
+
+import train_unet as train_module
+import train_replicates as replicates_module
+import predict_unet as predict_module
+import predict_unet_map as predict_map_module
+import distill_unet as distill_module
+try:
+    import assemble_unet_map as assemble_module
+    import tile_unet_map as tile_module
+    import roi_unet_map as roi_module
+except ImportError:                                              # rasterio missing: R tiles and assembles instead
+    assemble_module = tile_module = roi_module = None
+
+
+def _jsonable(x):
+    """Convert numpy scalars/arrays and tuples to plain JSON types"""
+    if isinstance(x, dict):
+        return {str(k): _jsonable(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [_jsonable(v) for v in x]
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+def job_train(args):
+    """Train one model; returns the model path and best CCR"""
+    model_path, ccr = train_module.train_unet(**args)
+    return {'model_path': model_path, 'ccr': ccr}
+
+
+def job_train_replicates(args):
+    """Train seed replicates as one batched model; returns model paths and best CCRs"""
+    return replicates_module.train_unet_replicates(**args)
+
+
+def job_predict(args):
+    """Predict a test/validate set; returns only the labeled-pixel vectors and probabilities (or file paths)"""
+    args.setdefault('result_mode', 'labeled')
+    results = predict_module.predict_unet(**args)
+    if args['result_mode'] == 'files':
+        return {k: v for k, v in results.items() if k != 'config'}
+    return {
+        'predictions': results['predictions'],
+        'labels': results['labels'],
+        'probabilities': results['probabilities'],
+        'original_classes': results['original_classes'],
+        'summary': results['summary'],
+    }
+
+
+def job_predict_map(args):
+    """Predict map patches; returns the path to the saved probabilities"""
+    return {'probs_path': predict_map_module.predict_unet_map(**args)}
+
+
+def job_distill(args):
+    """Distill an ensemble into one model; returns the student's paths, agreement and speedup"""
+    return distill_module.distill_unet(**args)
+
+
+def job_tile_map(args):
+    """Tile the map input stack into patches; returns patch and raster counts"""
+    if tile_module is None:
+        raise ImportError('tile_unet_map needs rasterio')
+    return tile_module.tile_unet_map(**args)
+
+
+def job_assemble_map(args):
+    """Assemble map probabilities into GeoTIFF(s); returns classes present and valid pixel count"""
+    if assemble_module is None:
+        raise ImportError('assemble_unet_map needs rasterio')
+    return assemble_module.assemble_unet_map(**args)
+
+
+def job_mosaic_roi(args):
+    """Write an assembled ROI into the full map; returns the number of pixels replaced"""
+    if roi_module is None:
+        raise ImportError('roi_unet_map needs rasterio')
+    return {'n_pixels': roi_module.mosaic_roi(**args)}
+
+
+def job_ping(args):
+    return {'pid': os.getpid(), 'cuda': torch.cuda.is_available(),
+            'torch': torch.__version__}
+
+
+JOBS = {
+    'train': job_train,
+    'train_replicates': job_train_replicates,
+    'predict': job_predict,
+    'predict_map': job_predict_map,
+    'distill': job_distill,
+    'tile_map': job_tile_map,
+    'assemble_map': job_assemble_map,
+    'mosaic_roi': job_mosaic_roi,
+    'ping': job_ping,
+}
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """Handle one request per connection"""
+
+    def handle(self):
+        t0 = time.time()
+        request = None                                           # unset if the request can't be read
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            if request.get('token') != self.server.token:
+                raise PermissionError('bad worker token')
+            op = request.get('op')
+            if op == 'shutdown':
+                self.server.stop_requested = True
+                response = {'ok': True, 'result': None}
+            elif op in JOBS:
+                print(f'\n>>> worker job: {op}')
+                response = {'ok': True, 'result': _jsonable(JOBS[op](request.get('args') or {}))}
+            else:
+                raise ValueError(f'unknown op: {op}')
+        except Exception as e:
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}',
+                        'traceback': traceback.format_exc()}
+            print(response['traceback'])
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        response['elapsed'] = time.time() - t0
+        try:
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):           # e.g. a ping that timed out while a job ran
+            print(f'client went away before the {request.get("op") if isinstance(request, dict) else "?"} response')
+
+
+class WorkerServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def serve(state_file):
+    """Bind to a free loopback port, publish it in state_file, and serve until shutdown"""
+    server = WorkerServer(('127.0.0.1', 0), WorkerHandler)
+    server.token = secrets.token_hex(16)
+    server.stop_requested = False
+    port = server.server_address[1]
+
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+    tmp = f'{state_file}.{os.getpid()}.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)   # token is a secret: owner-only
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'port': port, 'token': server.token, 'pid': os.getpid()}, f)
+    os.replace(tmp, state_file)
+
+    print(f'U-Net worker listening on 127.0.0.1:{port} (pid {os.getpid()})')
+    print(f'CUDA available: {torch.cuda.is_available()}')
+    try:
+        while not server.stop_requested:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        print('U-Net worker stopped')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Persistent U-Net worker')
+    parser.add_argument('--state', required=True, help='Path of the JSON state file to write')
+    serve(parser.parse_args().state)